@@ -0,0 +1,211 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import dataclass, field
+from time import monotonic
+
+import discord
+
+from reconcile import apply_badge_changes, get_ladder_key, \
+    get_member_badge_state, get_state_after_change, load_badge_states
+from seniority_badge import BadgeChange, RoleAffixes, compute_badge_change, \
+    get_badge_ladder
+from state_store import StateStore
+
+
+@dataclass
+class RecomputeProgress:
+    total: int = 0
+    checked: int = 0
+    changed: int = 0
+    failed: int = 0
+    # Members checked before the job was resumed.
+    resumed_at: int = 0
+    started_at: float = field(default_factory=monotonic)
+    done: bool = False
+
+    def __str__(self):
+        elapsed = monotonic() - self.started_at
+        rate = (self.checked - self.resumed_at) / elapsed if elapsed else 0.0
+        text = (f'{self.checked}/{self.total} members checked,'
+                f' {self.changed} changed, {self.failed} failed'
+                f' ({rate:.0f} members/s')
+        if self.resumed_at:
+            text += f', resumed at {self.resumed_at}'
+        return text + ').'
+
+
+def format_badge_changes(changes: list[BadgeChange]) -> str:
+    """List the changes, one member per line."""
+    lines = []
+    for change in changes:
+        roles = []
+        if change.role_to_add:
+            roles.append(f'+{change.role_to_add.name}')
+        roles += [f'-{role.name}' for role in change.roles_to_remove]
+        lines.append(
+            f'{change.member.name} ({change.member.id}): {" ".join(roles)}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_checkpoint_key(guild_id: int) -> str:
+    return f'badge_recompute:{guild_id}'
+
+
+class BadgeRecompute:
+    """Checks the badge of every member of a guild, in batches ordered by
+    member id.
+
+    Unlike the reconcile at startup, the stored badge states are not trusted,
+    so every member is checked. After each batch the states and the last
+    member id are stored, so that the job can resume after a restart. Batches
+    are started at most every `batch_interval` seconds to leave room for other
+    requests.
+    """
+
+    def __init__(self, guild: discord.Guild, role_affixes: RoleAffixes,
+                 status_channel: discord.TextChannel, store: StateStore,
+                 batch_size: int = 100, batch_interval: float = 1.0,
+                 fetch_members: bool = False):
+        self.guild = guild
+        self.role_affixes = role_affixes
+        self.status_channel = status_channel
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.fetch_members = fetch_members
+        self.progress = RecomputeProgress()
+        self.checkpoint_key = get_checkpoint_key(guild.id)
+
+    def _load_checkpoint(self, ladder_key: str) -> tuple[int, int]:
+        """Get the last member id and the number of members checked, or zeros
+        to start over."""
+        checkpoint = self.store.get_meta(self.checkpoint_key)
+        if checkpoint is None:
+            return 0, 0
+        checkpoint_ladder_key, last_member_id, checked = \
+            checkpoint.rsplit(':', 2)
+        # The badges checked so far were for other badge roles.
+        if checkpoint_ladder_key != ladder_key:
+            return 0, 0
+        return int(last_member_id), int(checked)
+
+    async def _members_after(self, member_id: int
+                             ) -> AsyncIterator[list[discord.Member]]:
+        if not self.fetch_members:
+            members = sorted(
+                (member for member in self.guild.members
+                 if member.id > member_id),
+                key=lambda member: member.id)
+            for i in range(0, len(members), self.batch_size):
+                yield members[i:i + self.batch_size]
+            return
+
+        # Discord returns the members ordered by id.
+        batch = []
+        async for member in self.guild.fetch_members(
+                limit=None, after=discord.Object(member_id)):
+            batch.append(member)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def dry_run(self) -> list[BadgeChange]:
+        """Compute the changes of every member without applying them."""
+        ladder = get_badge_ladder(self.guild, self.role_affixes)
+        self.progress.total = self.guild.member_count or 0
+        changes = []
+        async for batch in self._members_after(0):
+            for member in batch:
+                change = compute_badge_change(
+                    member, self.role_affixes, ladder)
+                if change:
+                    changes.append(change)
+            self.progress.checked += len(batch)
+        self.progress.done = True
+        return changes
+
+    async def run(self, on_progress: Callable[[RecomputeProgress],
+                                              Awaitable[None]]|None = None):
+        """Check every member, resuming from the checkpoint if there is one.
+
+        `on_progress` is awaited after every batch.
+        """
+        ladder = get_badge_ladder(self.guild, self.role_affixes)
+        ladder_key = get_ladder_key(ladder)
+        # Drops the stored states if they were for other badge roles.
+        load_badge_states(self.store, self.guild.id, ladder)
+        last_member_id, checked = self._load_checkpoint(ladder_key)
+        self.progress.total = self.guild.member_count or 0
+        self.progress.checked = self.progress.resumed_at = checked
+
+        async for batch in self._members_after(last_member_id):
+            batch_started_at = monotonic()
+            changes = []
+            states = {}
+            for member in batch:
+                role_ids = {role.id for role in member.roles}
+                change = compute_badge_change(
+                    member, self.role_affixes, ladder, role_ids)
+                if change:
+                    changes.append(change)
+                else:
+                    states[member.id] = get_member_badge_state(
+                        role_ids, ladder)
+
+            failed = await apply_badge_changes(changes, self.status_channel)
+            failed_ids = {change.member.id for change in failed}
+            for change in changes:
+                if change.member.id not in failed_ids:
+                    states[change.member.id] = get_state_after_change(
+                        change, ladder)
+
+            self.progress.checked += len(batch)
+            self.progress.changed += len(changes) - len(failed)
+            self.progress.failed += len(failed)
+            # Failed members are checked again by the next reconcile, since
+            # their state is not stored.
+            self.store.save_member_badges(self.guild.id, states)
+            self.store.set_meta(
+                self.checkpoint_key,
+                f'{ladder_key}:{batch[-1].id}:{self.progress.checked}')
+            if on_progress:
+                await on_progress(self.progress)
+            await asyncio.sleep(max(
+                0.0, self.batch_interval - (monotonic() - batch_started_at)))
+
+        self.progress.done = True
+        self.store.delete_meta(self.checkpoint_key)
+        if on_progress:
+            await on_progress(self.progress)
+
+
+class ProgressMessage:
+    """A message that is edited in place to show the progress of a job, at
+    most every `interval` seconds."""
+
+    def __init__(self, channel: discord.abc.Messageable, title: str,
+                 interval: float = 5.0):
+        self.channel = channel
+        self.title = title
+        self.interval = interval
+        self.message: discord.Message|None = None
+        self._edited_at = 0.0
+
+    async def update(self, progress: RecomputeProgress):
+        if (not progress.done
+                and monotonic() - self._edited_at < self.interval):
+            return
+        self._edited_at = monotonic()
+        content = f'{self.title}: {progress}'
+        if progress.done:
+            content = f'{self.title} done: {progress}'
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(content)
+            else:
+                await self.message.edit(content=content)
+        except discord.HTTPException as error:
+            # The progress is not worth stopping the job for.
+            print(f'Could not show the progress: {error}')
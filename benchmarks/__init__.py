@@ -0,0 +1,4 @@
+"""Offline benchmarks of the bot's hot paths, run against fake guilds.
+
+Run with `python -m benchmarks`.
+"""
@@ -0,0 +1,276 @@
+"""Run the benchmarks and compare them with the stored baselines.
+
+    python -m benchmarks [--members N] [--only NAME] [--update-baselines]
+
+Each benchmark reports the wall time, the peak memory allocated and the
+requests that would have been made to Discord. A benchmark regresses if it
+makes more requests than its baseline, not counting the status log messages
+whose number depends on timing, or allocates much more memory. The wall time
+varies too much between runs to fail on, so a much slower run is only noted.
+"""
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass
+import io
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+from benchmarks.fakes import FakeInvite, FakeMember, api_calls, make_guild
+import bot_logging
+from config import parse_category_setup
+import helpers
+from invites import InviteTracker
+from member_updates import MemberUpdateStats, PendingRoleMutations, \
+    should_adjust_badge
+from public_category import create_category_overwrites, \
+    create_channel_overwrites
+from reconcile import reconcile_badges
+from role_writes import role_writes
+from seniority_badge import RoleAffixes, get_badge_ladder
+from state_store import StateStore
+
+BASELINES_FILENAME = os.path.join(os.path.dirname(__file__), 'baselines.json')
+ROLE_AFFIXES = RoleAffixes('Tävlande', 'Märke', '⭐')
+# Not counted when comparing with the baselines.
+UNGATED_CALLS = {'send_message'}
+
+
+@dataclass
+class Result:
+    name: str
+    wall: float # seconds
+    peak_bytes: int
+    api_calls: dict[str, int]
+
+    @property
+    def total_api_calls(self) -> int:
+        return sum(self.api_calls.values())
+
+    def __str__(self):
+        calls = ', '.join(f'{call} {count}'
+                          for call, count in sorted(self.api_calls.items()))
+        return (f'{self.name:<28} {self.wall * 1000:9.1f} ms'
+                f' {self.peak_bytes / 1024:9.0f} KiB'
+                f'  API calls: {self.total_api_calls} ({calls or "none"})')
+
+
+async def bench_badge_reconcile(members: int):
+    synthetic = make_guild(members)
+    yield
+    await reconcile_badges(synthetic.guild, ROLE_AFFIXES,
+                           synthetic.status_channel)
+    await bot_logging.flush_logs()
+
+
+async def bench_badge_reconcile_warm(members: int):
+    """A restart where the store already knows every member."""
+    synthetic = make_guild(members)
+    with tempfile.TemporaryDirectory() as directory:
+        store = StateStore(os.path.join(directory, 'state.db'))
+        await reconcile_badges(synthetic.guild, ROLE_AFFIXES,
+                               synthetic.status_channel, store=store)
+        await bot_logging.flush_logs()
+        yield
+        await reconcile_badges(synthetic.guild, ROLE_AFFIXES,
+                               synthetic.status_channel, store=store)
+        await bot_logging.flush_logs()
+        store.close()
+
+
+async def bench_helpers_lookups(members: int):
+    synthetic = make_guild(0)
+    guild = synthetic.guild
+    names = [role.name for role in guild.roles]
+    yield
+    for i in range(members):
+        helpers.get_role_by_name(guild, names[i % len(names)])
+        helpers.get_first_role_by_prefix(guild, 'Tävlande',
+                                          synthetic.year_roles[0])
+        helpers.get_text_channel_by_name(guild, 'status')
+
+
+async def bench_invite_join_burst(members: int):
+    """Joins arriving at the same time, a hundredth of the members."""
+    synthetic = make_guild(0)
+    guild = synthetic.guild
+    channel = synthetic.status_channel
+    guild.fake_invites = [FakeInvite(f'code{i}', 0, channel)
+                          for i in range(20)]
+    tracker = InviteTracker(guild, join_window=0.01)
+    await tracker.snapshot()
+    joins = max(1, members // 100)
+    yield
+    guild.fake_invites[0].uses += joins
+    new_members = [FakeMember(i, guild, set()) for i in range(joins)]
+    await asyncio.gather(*(tracker.attribute(member)
+                           for member in new_members))
+
+
+async def bench_channel_overwrites(members: int):
+    """Overwrites for every channel of the category setup, once per 100
+    members."""
+    synthetic = make_guild(0)
+    guild = synthetic.guild
+    with open('category_setup.json', encoding='utf-8') as json_file:
+        channels = parse_category_setup(json.load(json_file)).channels
+    role_names = {permission.role for channel in channels
+                  for permission in channel.permissions}
+    for i, name in enumerate(sorted(role_names - {'@everyone'})):
+        if not helpers.get_role_by_name(guild, name):
+            guild.add_role(name, 1000 + i)
+    robot_group_role = helpers.get_role_by_name(guild, 'Robotgruppen')
+    year_role = synthetic.year_roles[-1]
+    category_overwrites = create_category_overwrites(
+        guild, robot_group_role, year_role)
+    yield
+    for _ in range(max(1, members // 100)):
+        for channel in channels:
+            await create_channel_overwrites(
+                guild, synthetic.status_channel, category_overwrites,
+                channel.permissions, year_role, 'Tävlande')
+
+
+async def bench_badge_reconcile_uncached(members: int):
+    """Reconcile with the members fetched in chunks, as when running without
+    a member cache."""
+    synthetic = make_guild(members)
+    yield
+    await reconcile_badges(synthetic.guild, ROLE_AFFIXES,
+                           synthetic.status_channel, fetch_members=True)
+    await bot_logging.flush_logs()
+
+
+async def bench_member_update_filter(members: int):
+    """One team role change per member."""
+    synthetic = make_guild(members)
+    guild = synthetic.guild
+    ladder = get_badge_ladder(guild, ROLE_AFFIXES)
+    stats = MemberUpdateStats()
+    pending = PendingRoleMutations()
+    updates = [
+        (member, FakeMember(member.id, guild,
+                            member.role_ids ^ {synthetic.other_roles[0].id}))
+        for member in guild.members]
+    yield
+    for before, after in updates:
+        should_adjust_badge(before, after, ladder.badge_related_role_ids,
+                            stats, pending)
+
+
+BENCHMARKS = {
+    'badge_reconcile': bench_badge_reconcile,
+    'badge_reconcile_warm': bench_badge_reconcile_warm,
+    'badge_reconcile_uncached': bench_badge_reconcile_uncached,
+    'helpers_lookups': bench_helpers_lookups,
+    'invite_join_burst': bench_invite_join_burst,
+    'channel_overwrites': bench_channel_overwrites,
+    'member_update_filter': bench_member_update_filter,
+}
+
+
+async def _run_measured(name: str, members: int, trace_memory: bool
+                        ) -> tuple[float, int]:
+    # The fake guilds reuse ids, so the roles written to members of an
+    # earlier guild must not be trusted.
+    role_writes.forget_writes()
+    benchmark = BENCHMARKS[name](members)
+    with redirect_stdout(io.StringIO()):
+        await anext(benchmark)
+        api_calls.clear()
+        if trace_memory:
+            tracemalloc.start()
+        start = perf_counter()
+        try:
+            await anext(benchmark)
+        except StopAsyncIteration:
+            pass
+        wall = perf_counter() - start
+        peak = 0
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return wall, peak
+
+
+async def run_benchmark(name: str, members: int) -> Result:
+    """Run a benchmark, measuring only what comes after its setup yields.
+
+    Memory is traced in a second run, since tracing slows everything down.
+    """
+    wall, _ = await _run_measured(name, members, trace_memory=False)
+    calls = dict(api_calls)
+    _, peak = await _run_measured(name, members, trace_memory=True)
+    return Result(name, wall, peak, calls)
+
+
+def count_gated_calls(api_calls: dict[str, int]) -> int:
+    # Status logs are merged by time, so how many messages they take depends
+    # on timing.
+    return sum(count for call, count in api_calls.items()
+               if call not in UNGATED_CALLS)
+
+
+def compare(result: Result, baseline: dict, tolerance: float) -> list[str]:
+    """Describe how the result regressed compared to the baseline."""
+    regressions = []
+    calls = count_gated_calls(result.api_calls)
+    baseline_calls = count_gated_calls(baseline['api_calls'])
+    if calls > baseline_calls:
+        regressions.append(
+            f'{calls} API calls, baseline {baseline_calls}')
+    if result.peak_bytes > baseline['peak_bytes'] * tolerance:
+        regressions.append(
+            f'{result.peak_bytes / 1024:.0f} KiB, baseline'
+            f' {baseline["peak_bytes"] / 1024:.0f} KiB')
+    return regressions
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=10_000)
+    parser.add_argument('--only', choices=BENCHMARKS, action='append')
+    parser.add_argument('--update-baselines', action='store_true')
+    parser.add_argument(
+        '--tolerance', type=float, default=2.0,
+        help='how many times larger than the baseline is allowed')
+    args = parser.parse_args()
+
+    # Merge log messages like the bot does, but without waiting as long.
+    bot_logging.configure_status_logs(flush_interval=0.01)
+
+    try:
+        with open(BASELINES_FILENAME, encoding='utf-8') as json_file:
+            baselines = json.load(json_file)
+    except FileNotFoundError:
+        baselines = {}
+
+    regressed = False
+    for name in args.only or BENCHMARKS:
+        result = await run_benchmark(name, args.members)
+        print(result)
+        key = f'{name}@{args.members}'
+        if args.update_baselines:
+            baselines[key] = asdict(result)
+        elif key in baselines:
+            baseline = baselines[key]
+            for regression in compare(result, baseline, args.tolerance):
+                print(f'  REGRESSION: {regression}')
+                regressed = True
+            if result.wall > baseline['wall'] * args.tolerance:
+                print(f'  Slower: {result.wall * 1000:.1f} ms, baseline'
+                      f' {baseline["wall"] * 1000:.1f} ms')
+
+    if args.update_baselines:
+        with open(BASELINES_FILENAME, 'w', encoding='utf-8') as json_file:
+            json.dump(baselines, json_file, indent=4, sort_keys=True)
+            json_file.write('\n')
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,282 @@
+"""Lightweight stand-ins for the discord.py objects the bot uses.
+
+Every method that would make a request to Discord goes through `rest`
+instead, which counts the call in `api_calls`.
+"""
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import total_ordering
+import random
+
+from discord import ChannelType, PermissionOverwrite
+
+api_calls = Counter()
+
+
+class FakeRest:
+    """Stands in for Discord's REST API.
+
+    Requests are counted in `api_calls`, and can be made to take `latency`
+    seconds and to be rate limited with a probability of `rate_limit_chance`.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit_chance: float = 0.0,
+                 retry_after: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+        self.rate_limited = 0
+        self.rng = random.Random(seed)
+
+    async def request(self, name: str):
+        api_calls[name] += 1
+        if not self.latency and not self.rate_limit_chance:
+            return
+        # discord.py waits out rate limits and tries again by itself.
+        while self.rng.random() < self.rate_limit_chance:
+            self.rate_limited += 1
+            await asyncio.sleep(self.retry_after)
+        await asyncio.sleep(self.latency)
+
+
+# Requests made by the fakes are instant unless configured otherwise.
+rest = FakeRest()
+
+
+@total_ordering
+class FakeRole:
+    def __init__(self, id: int, name: str, position: int):
+        self.id = id
+        self.name = name
+        self.position = position
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __lt__(self, other):
+        return (self.position, self.id) < (other.position, other.id)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<FakeRole {self.name!r}>'
+
+
+class FakeTextChannel:
+    type = ChannelType.text
+
+    def __init__(self, id: int, name: str, position: int,
+                 category: 'FakeCategory|None' = None, topic: str = ''):
+        self.id = id
+        self.name = name
+        self.position = position
+        self.category = category
+        self.category_id = category.id if category else None
+        self.topic = topic
+        self.overwrites: dict[FakeRole, PermissionOverwrite] = {}
+        self.sent: list[str] = []
+
+    @property
+    def mention(self):
+        return f'<#{self.id}>'
+
+    async def send(self, content: str = '', **kwargs):
+        await rest.request('send_message')
+        self.sent.append(content)
+
+    async def edit(self, **kwargs):
+        await rest.request('edit_channel')
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        return self
+
+
+class FakeCategory:
+    type = ChannelType.category
+
+    def __init__(self, id: int, name: str, position: int):
+        self.id = id
+        self.name = name
+        self.position = position
+        self.channels: list[FakeTextChannel] = []
+        self.overwrites: dict[FakeRole, PermissionOverwrite] = {}
+        self.guild: 'FakeGuild|None' = None
+
+    @property
+    def text_channels(self):
+        return sorted(self.channels, key=lambda c: (c.position, c.id))
+
+
+class FakeMember:
+    def __init__(self, id: int, guild: 'FakeGuild', role_ids: set[int]):
+        self.id = id
+        self.name = f'member{id}'
+        self.bot = False
+        self.guild = guild
+        self.role_ids = set(role_ids)
+
+    @property
+    def roles(self):
+        return sorted(self.guild.get_role(role_id) for role_id in self.role_ids)
+
+    def get_role(self, role_id: int):
+        return self.guild.get_role(role_id) if role_id in self.role_ids else None
+
+    async def add_roles(self, *roles, **kwargs):
+        await rest.request('add_roles')
+        self.role_ids |= {role.id for role in roles}
+
+    async def remove_roles(self, *roles, **kwargs):
+        await rest.request('remove_roles')
+        self.role_ids -= {role.id for role in roles}
+
+    async def edit(self, *, roles=None, **kwargs):
+        await rest.request('edit_member')
+        if roles is not None:
+            self.role_ids = {role.id for role in roles}
+
+
+@dataclass
+class FakeMessage:
+    channel: FakeTextChannel
+    author: FakeMember
+    guild: 'FakeGuild'
+    content: str = ''
+    created_at: datetime = field(
+        default_factory=lambda: datetime.now(timezone.utc))
+
+
+@dataclass
+class FakeInvite:
+    code: str
+    uses: int
+    channel: FakeTextChannel
+    max_uses: int = 0
+    guild: 'FakeGuild|None' = None
+
+
+class FakeGuild:
+    def __init__(self, id: int = 1):
+        self.id = id
+        self.name = f'guild{id}'
+        self._roles: dict[int, FakeRole] = {}
+        self.channels: list = []
+        self.members: list[FakeMember] = []
+        self.fake_invites: list[FakeInvite] = []
+        self.default_role = self.add_role('@everyone', 0)
+
+    def add_role(self, name: str, position: int, id: int|None = None
+                 ) -> FakeRole:
+        role = FakeRole(id or len(self._roles) + 1000, name, position)
+        self._roles[role.id] = role
+        return role
+
+    def add_category(self, name: str, id: int|None = None) -> FakeCategory:
+        category = FakeCategory(id or len(self.channels) + 10_000, name,
+                                len(self.categories))
+        category.guild = self
+        self.channels.append(category)
+        return category
+
+    def add_text_channel(self, name: str, category: FakeCategory|None = None,
+                         id: int|None = None) -> FakeTextChannel:
+        channel = FakeTextChannel(id or len(self.channels) + 10_000, name,
+                                  len(self.text_channels), category)
+        self.channels.append(channel)
+        if category:
+            category.channels.append(channel)
+        return channel
+
+    @property
+    def roles(self):
+        return sorted(self._roles.values())
+
+    @property
+    def categories(self):
+        return sorted((c for c in self.channels
+                       if c.type == ChannelType.category),
+                      key=lambda c: (c.position, c.id))
+
+    @property
+    def text_channels(self):
+        return sorted((c for c in self.channels if c.type == ChannelType.text),
+                      key=lambda c: (c.position, c.id))
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+    def get_role(self, role_id: int):
+        return self._roles.get(role_id)
+
+    def get_member(self, member_id: int):
+        return next((m for m in self.members if m.id == member_id), None)
+
+    async def fetch_members(self, limit: int|None = 1000):
+        # Discord returns at most 1000 members per request, ordered by id.
+        members = sorted(self.members, key=lambda member: member.id)[:limit]
+        for i, member in enumerate(members):
+            if i % 1000 == 0:
+                await rest.request('fetch_members')
+            yield member
+
+    async def invites(self):
+        await rest.request('fetch_invites')
+        return [FakeInvite(invite.code, invite.uses, invite.channel,
+                           invite.max_uses, self)
+                for invite in self.fake_invites]
+
+
+@dataclass
+class SyntheticGuild:
+    guild: FakeGuild
+    year_roles: list[FakeRole]
+    badge_roles: list[FakeRole]
+    other_roles: list[FakeRole]
+    status_channel: FakeTextChannel
+    extra: dict = field(default_factory=dict)
+
+
+def make_guild(members: int, roles: int = 300, years: int = 15,
+               seed: int = 0) -> SyntheticGuild:
+    """Make a guild of competitors from several years, with random badges.
+
+    About a third of the members have the wrong badge.
+    """
+    rng = random.Random(seed)
+    guild = FakeGuild()
+    position = 1
+    other_roles = []
+    for i in range(max(0, roles - years - 3)):
+        other_roles.append(guild.add_role(f'Team {i}', position))
+        position += 1
+    year_roles = []
+    for year in range(2010, 2010 + years):
+        year_roles.append(guild.add_role(f'Tävlande {year}', position))
+        position += 1
+    badge_roles = []
+    for name in ('Grön', 'Blå', 'Lila'):
+        badge_roles.append(guild.add_role(f'Märke {name} ⭐', position))
+        position += 1
+    guild.add_role('Robotgruppen', position)
+
+    category = guild.add_category('Bot')
+    status_channel = guild.add_text_channel('status', category)
+
+    for member_id in range(1, members + 1):
+        role_ids = {role.id for role in rng.sample(
+            year_roles, rng.choice((0, 0, 1, 1, 2, 3, 4)))}
+        role_ids |= {rng.choice(other_roles).id} if other_roles else set()
+        badge_index = min(len(role_ids & {r.id for r in year_roles}),
+                          len(badge_roles)) - 1
+        if rng.random() < 1 / 3:
+            badge_index = rng.randrange(-1, len(badge_roles))
+        if badge_index >= 0:
+            role_ids.add(badge_roles[badge_index].id)
+        guild.members.append(FakeMember(member_id, guild, role_ids))
+
+    return SyntheticGuild(guild, year_roles, badge_roles, other_roles,
+                          status_channel)
@@ -0,0 +1,260 @@
+"""Replay a recorded trace of events against the bot, without Discord.
+
+    python -m benchmarks.replay TRACE [--speed N] [--latency S]
+                                [--rate-limit-chance P]
+
+The trace is recorded by the bot when `debug.trace_file` is set. The events
+are replayed at their recorded pace times `--speed`, or as fast as possible
+with `--speed 0`, against a HouseRobot using the settings, responses and
+category setup files. Requests to Discord go to the fakes, which can be made
+slow and rate limited. The report shows the events handled per second, the
+latency of the handlers and the requests made.
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from contextlib import redirect_stdout
+from dataclasses import replace
+import io
+import json
+import os
+import sys
+import tempfile
+from time import monotonic
+
+from discord import Intents
+
+from benchmarks.fakes import FakeGuild, FakeInvite, FakeMember, FakeMessage, \
+    api_calls, rest
+import bot_logging
+from config import ConfigError, ConfigWatcher
+from house_robot import HouseRobot
+
+
+def load_trace(filename: str) -> list[dict]:
+    with open(filename, encoding='utf-8') as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def build_guild(record: dict) -> FakeGuild:
+    """Make a fake guild with the roles, channels and members of a guild
+    record."""
+    guild = FakeGuild(record['g'])
+    # The @everyone role has the id of the guild, like in Discord.
+    guild._roles.clear()
+    for role_id, name, position in record['roles']:
+        guild.add_role(name, position, id=role_id)
+    guild.default_role = (guild.get_role(guild.id)
+                          or guild.add_role('@everyone', 0, id=guild.id))
+    categories = {}
+    for channel_id, name, kind, _, position in record['channels']:
+        if kind == 'category':
+            categories[channel_id] = guild.add_category(name, id=channel_id)
+            categories[channel_id].position = position
+    for channel_id, name, kind, category_id, position in record['channels']:
+        if kind == 'text':
+            channel = guild.add_text_channel(
+                name, categories.get(category_id), id=channel_id)
+            channel.position = position
+    for member_id, role_ids in record['members']:
+        guild.members.append(FakeMember(member_id, guild, role_ids))
+    return guild
+
+
+def get_invites(guild: FakeGuild, record: dict) -> list[FakeInvite]:
+    channels = {channel.id: channel for channel in guild.text_channels}
+    return [FakeInvite(code, uses, channels[channel_id], max_uses, guild)
+            for code, channel_id, uses, max_uses in record['invites']
+            if channel_id in channels]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Replay:
+    """Replays the records of a trace against a bot."""
+
+    def __init__(self, robot: HouseRobot, records: list[dict],
+                 speed: float):
+        self.robot = robot
+        self.records = records
+        self.speed = speed
+        self.guilds: dict[int, FakeGuild] = {}
+        # Seconds from when each event was due until it was handled, by kind.
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.startup_time = 0.0
+        self.startup_api_calls = 0
+        self.replay_time = 0.0
+        # The invite uses right after each join, which the bot fetches to
+        # tell which invite was used.
+        self.invites_after: dict[int, dict] = {}
+        next_invites = {}
+        for i in reversed(range(len(records))):
+            record = records[i]
+            if record['e'] == 'invites':
+                next_invites[record['g']] = record
+            elif record['e'] == 'member_join' and record['g'] in next_invites:
+                self.invites_after[i] = next_invites[record['g']]
+
+    async def start_guild(self, record: dict):
+        guild = self.guilds[record['g']] = build_guild(record)
+        robot = self.robot
+        # Pretend the commands are synced, since they can't be.
+        robot.tree.copy_global_to(guild=guild)
+        robot.store.set_meta(f'command_sync_fingerprint:{guild.id}',
+                             robot.get_command_fingerprint(guild))
+        start = monotonic()
+        await robot._start_guild(guild)
+        self.startup_time += monotonic() - start
+
+    async def handle(self, i: int, record: dict):
+        robot = self.robot
+        guild = self.guilds[record['g']]
+        kind = record['e']
+        if kind == 'member_join':
+            if i in self.invites_after:
+                guild.fake_invites = get_invites(guild, self.invites_after[i])
+            member = FakeMember(record['m'], guild, record['r'])
+            guild.members.append(member)
+            await robot.on_member_join(member)
+        elif kind == 'member_update':
+            before = FakeMember(record['m'], guild, record['b'])
+            member = guild.get_member(record['m'])
+            if member is None:
+                member = FakeMember(record['m'], guild, record['r'])
+                guild.members.append(member)
+            member.role_ids = set(record['r'])
+            await robot.on_member_update(before, member)
+        elif kind == 'message':
+            author = (guild.get_member(record['m'])
+                      or FakeMember(record['m'], guild, record['r']))
+            author.bot = record['bot']
+            channel = next((channel for channel in guild.text_channels
+                            if channel.id == record['c']), None)
+            if channel is not None:
+                await robot.on_message(FakeMessage(channel, author, guild))
+        elif kind in ('invite_create', 'invite_delete'):
+            channel = next(channel for channel in guild.text_channels
+                           if channel.id == record['c'])
+            invite = FakeInvite(record['i'], record['uses'], channel,
+                                record['max_uses'], guild)
+            if kind == 'invite_create':
+                guild.fake_invites.append(invite)
+                await robot.on_invite_create(invite)
+            else:
+                guild.fake_invites = [other for other in guild.fake_invites
+                                      if other.code != invite.code]
+                await robot.on_invite_delete(invite)
+        elif kind == 'invites':
+            guild.fake_invites = get_invites(guild, record)
+
+    async def run(self):
+        events = []
+        for i, record in enumerate(self.records):
+            if record['e'] == 'guild':
+                await self.start_guild(record)
+            elif record['g'] in self.guilds:
+                events.append((i, record))
+
+        async def handle(i: int, record: dict, due: float):
+            await self.handle(i, record)
+            self.latencies[record['e']].append(monotonic() - due)
+
+        # Only the requests made while replaying are reported.
+        self.startup_api_calls = sum(api_calls.values())
+        api_calls.clear()
+        tasks = []
+        start = monotonic()
+        first_t = events[0][1]['t'] if events else 0.0
+        for i, record in events:
+            due = start
+            if self.speed:
+                due += (record['t'] - first_t) / self.speed
+                await asyncio.sleep(max(0.0, due - monotonic()))
+            if record['e'] == 'invites':
+                # Not an event, only the state of the invites.
+                await self.handle(i, record)
+                continue
+            tasks.append(asyncio.create_task(handle(i, record, due)))
+        await asyncio.gather(*tasks)
+        self.replay_time = monotonic() - start
+
+    def __str__(self):
+        events = sum(len(latencies) for latencies in self.latencies.values())
+        rate = events / self.replay_time if self.replay_time else 0.0
+        lines = [
+            f'{events} events in {self.replay_time:.2f} s'
+            f' ({rate:.1f} events/s). Guild startup took'
+            f' {self.startup_time:.2f} s and {self.startup_api_calls} API'
+            f' calls.']
+        for kind, latencies in sorted(self.latencies.items()):
+            lines.append(
+                f'  {kind:<16} {len(latencies):6} events,'
+                f' p50 {percentile(latencies, 50) * 1000:8.1f} ms,'
+                f' p99 {percentile(latencies, 99) * 1000:8.1f} ms')
+        calls = ', '.join(f'{call} {count}'
+                          for call, count in sorted(api_calls.items()))
+        lines.append(f'API calls: {sum(api_calls.values())}'
+                     f' ({calls or "none"}), {rest.rate_limited} rate limited.')
+        return '\n'.join(lines)
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='how many times faster than recorded, or 0 for maximum speed')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every request to Discord takes')
+    parser.add_argument('--rate-limit-chance', type=float, default=0.0,
+                        help='probability that a request is rate limited')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--settings', default='settings.json')
+    parser.add_argument('--responses', default='responses.json')
+    parser.add_argument('--category-setup', default='category_setup.json')
+    args = parser.parse_args()
+    if not __debug__:
+        # The doorbell would use the GPIO pins.
+        raise SystemExit('Run the replay without -O.')
+
+    rest.latency = args.latency
+    rest.rate_limit_chance = args.rate_limit_chance
+    rest.retry_after = args.retry_after
+    bot_logging.configure_status_logs(flush_interval=0.01)
+
+    try:
+        config_watcher = ConfigWatcher(
+            args.settings, args.responses, args.category_setup)
+    except ConfigError as error:
+        raise SystemExit(error)
+    with tempfile.TemporaryDirectory() as directory:
+        # Nothing of the real state is used or changed, and nothing is
+        # recorded.
+        config = config_watcher.config
+        settings = replace(
+            config.settings,
+            state_file=os.path.join(directory, 'replay.db'),
+            debug=replace(config.settings.debug, log_file='', trace_file=''))
+        config_watcher.config = replace(config, settings=settings)
+
+        robot = HouseRobot(config_watcher, intents=Intents.default())
+        robot.register_commands()
+        replay = Replay(robot, load_trace(args.trace), args.speed)
+        try:
+            with redirect_stdout(io.StringIO()):
+                await replay.run()
+                await bot_logging.flush_logs()
+        finally:
+            robot.store.close()
+            robot.doorbell.close()
+    print(replay)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
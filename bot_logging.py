@@ -1,7 +1,176 @@
-from discord import TextChannel
+import asyncio
+import logging
+from logging.handlers import RotatingFileHandler
+from time import monotonic
 
+from discord import HTTPException, TextChannel
 
-async def log(channel: TextChannel, message: str):
-    """Write a message to a channel and print it to the console."""
-    await channel.send(message)
+# Discord rejects longer messages.
+MAX_MESSAGE_LENGTH = 2000
+
+_file_logger = logging.getLogger('house_robot')
+
+
+def setup_file_logging(filename: str, max_bytes: int = 1_000_000,
+                       backup_count: int = 3):
+    """Also write every logged message to a rotating file."""
+    handler = RotatingFileHandler(filename, maxBytes=max_bytes,
+                                  backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    _file_logger.addHandler(handler)
+    _file_logger.setLevel(logging.INFO)
+    # Don't print the messages a second time through the root logger.
+    _file_logger.propagate = False
+
+
+def pack_messages(messages: list[str]) -> list[str]:
+    """Join messages into as few Discord messages as possible.
+
+    Messages that are too long on their own are split.
+    """
+    packed = []
+    current = ''
+    for message in messages:
+        while len(message) > MAX_MESSAGE_LENGTH:
+            if current:
+                packed.append(current)
+                current = ''
+            packed.append(message[:MAX_MESSAGE_LENGTH])
+            message = message[MAX_MESSAGE_LENGTH:]
+        if not current:
+            current = message
+        elif len(current) + 1 + len(message) <= MAX_MESSAGE_LENGTH:
+            current += '\n' + message
+        else:
+            packed.append(current)
+            current = message
+    if current:
+        packed.append(current)
+    return packed
+
+
+class StatusLog:
+    """Sends the messages logged to a channel in the background.
+
+    Messages are queued and merged so that a burst of log lines only costs a
+    few requests, and so that the code logging never waits for Discord. The
+    queue is flushed when `flush_interval` seconds passed since the oldest
+    queued message, or when enough text is queued to fill a Discord message.
+
+    When more than `max_pending` messages are queued, either the oldest
+    messages are dropped (`overflow='drop'`) or the code logging has to wait
+    (`overflow='block'`).
+    """
+
+    def __init__(self, channel: TextChannel, flush_interval: float = 1.0,
+                 max_pending: int = 1000, overflow: str = 'drop'):
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f'Unknown overflow policy {overflow}.')
+        self.channel = channel
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.sent = 0
+        self._task: asyncio.Task|None = None
+
+    async def put(self, message: str):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_forever())
+        if self.overflow == 'block':
+            await self.queue.put(message)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+
+    async def _collect(self) -> list[str]:
+        """Wait for the next batch of messages."""
+        messages = [await self.queue.get()]
+        length = len(messages[0])
+        deadline = monotonic() + self.flush_interval
+        while length < MAX_MESSAGE_LENGTH:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            messages.append(message)
+            length += len(message) + 1
+        return messages
+
+    async def _flush_forever(self):
+        while True:
+            messages = await self._collect()
+            collected = len(messages)
+            if self.dropped:
+                messages.append(
+                    f'({self.dropped} log messages dropped, see the log file.)')
+                self.dropped = 0
+            try:
+                for text in pack_messages(messages):
+                    await self.channel.send(text)
+                    self.sent += 1
+            except HTTPException as error:
+                print(f'Could not send log messages to {self.channel}: {error}')
+            finally:
+                for _ in range(collected):
+                    self.queue.task_done()
+
+    async def flush(self):
+        """Wait until every queued message has been sent."""
+        if self._task is not None and not self._task.done():
+            await self.queue.join()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+_status_logs: dict[int, StatusLog] = {}
+_status_log_options = {}
+
+
+def configure_status_logs(**options):
+    """Set the StatusLog options used for channels logged to from now on."""
+    _status_log_options.update(options)
+
+
+def get_status_log(channel: TextChannel) -> StatusLog:
+    status_log = _status_logs.get(channel.id)
+    if status_log is None:
+        status_log = _status_logs[channel.id] = StatusLog(
+            channel, **_status_log_options)
+    # discord.py creates new channel objects after a reconnect.
+    status_log.channel = channel
+    return status_log
+
+
+async def flush_logs():
+    """Send all queued log messages, e.g. before shutting down."""
+    for status_log in _status_logs.values():
+        await status_log.flush()
+        status_log.close()
+
+
+def log_local(message: str):
+    """Print a message and write it to the log file, but not to Discord."""
     print(message)
+    _file_logger.info(message)
+
+
+async def log(channel: TextChannel, message: str):
+    """Write a message to a channel and print it to the console.
+
+    The message is sent to the channel in the background, so this only waits
+    if too many messages are queued and the overflow policy is to block.
+    """
+    log_local(message)
+    await get_status_log(channel).put(message)
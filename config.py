@@ -0,0 +1,373 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, fields
+import json
+import os
+import traceback
+
+from discord import Permissions
+
+from seniority_badge import RoleAffixes
+
+
+class ConfigError(Exception):
+    """A configuration file is missing, isn't valid JSON or has wrong keys."""
+
+
+_REQUIRED = object()
+
+
+class _Reader:
+    """Reads values from parsed JSON, collecting every problem with the path
+    to the value instead of stopping at the first."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.problems: list[str] = []
+
+    def value(self, data: dict, key: str, kind: type, path: str,
+              default=_REQUIRED):
+        if not isinstance(data, dict) or key not in data:
+            if default is _REQUIRED:
+                self.problems.append(f'{path}{key} is missing.')
+            return default
+        value = data[key]
+        # Integers are fine where floats are expected, but booleans are not
+        # integers here.
+        if kind is float and isinstance(value, int) \
+                and not isinstance(value, bool):
+            value = float(value)
+        if not isinstance(value, kind) or (
+                kind is int and isinstance(value, bool)):
+            self.problems.append(
+                f'{path}{key} should be {kind.__name__}, not'
+                f' {type(value).__name__}.')
+            return default if default is not _REQUIRED else kind()
+        return value
+
+    def section(self, data: dict, key: str, path: str,
+                required: bool = True) -> dict:
+        return self.value(data, key, dict, path,
+                          _REQUIRED if required else {})
+
+    def raise_problems(self):
+        if self.problems:
+            raise ConfigError(
+                f'{self.filename} is not valid:\n' + '\n'.join(
+                    f'- {problem}' for problem in self.problems))
+
+
+@dataclass(frozen=True)
+class DebugSettings:
+    status_channel: str
+    log_file: str = ''
+    trace_file: str = ''
+    startup_profile_file: str = ''
+
+
+@dataclass(frozen=True)
+class InviteRole:
+    """Members invited to `channel` are given `role`."""
+    channel: str
+    role: str
+
+
+@dataclass(frozen=True)
+class DoorbellSettings:
+    pin: int
+    channel: str
+    allowed_user_role: str = ''
+    cooldown: float = 2.0
+
+
+@dataclass(frozen=True)
+class MetricsSettings:
+    host: str = '127.0.0.1'
+    port: int = 0
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The parsed settings.json."""
+    discord_token: str
+    debug: DebugSettings
+    invites: tuple[InviteRole, ...]
+    doorbell: DoorbellSettings
+    seniority_badge: RoleAffixes
+    metrics: MetricsSettings
+    state_file: str = 'house_robot.db'
+    sharded: bool = False
+    # Without discord.py's member cache, the members are fetched when needed.
+    member_cache: bool = True
+    guild_startup_timeout: float = 600.0
+    # Seconds between checks of the configuration files, 0 to never reload.
+    config_reload_interval: float = 5.0
+
+    def changed_sections(self, other: 'Settings') -> set[str]:
+        return {field.name for field in fields(self)
+                if getattr(self, field.name) != getattr(other, field.name)}
+
+
+# Sections that are only read at startup.
+RESTART_SECTIONS = frozenset({
+    'discord_token', 'state_file', 'sharded', 'member_cache', 'metrics'})
+
+
+@dataclass(frozen=True)
+class DoorbellResponses:
+    """The parsed responses.json."""
+    ok: str
+    invalid_role: str
+
+
+@dataclass(frozen=True)
+class ChannelPermissions:
+    role: str
+    add: tuple[str, ...] = ()
+    remove: tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class ChannelSetup:
+    name: str
+    topic: str
+    permissions: tuple[ChannelPermissions, ...] = ()
+
+
+@dataclass(frozen=True)
+class CategorySetup:
+    """The parsed category_setup.json."""
+    channels: tuple[ChannelSetup, ...]
+
+
+@dataclass(frozen=True)
+class Config:
+    settings: Settings
+    responses: DoorbellResponses
+    # None if there is no category setup file, which is only needed by the
+    # setup_channels command.
+    category_setup: CategorySetup|None
+
+    def changed_sections(self, other: 'Config') -> set[str]:
+        """Names of the settings sections, and 'responses' or
+        'category_setup', that differ between the configs."""
+        changed = self.settings.changed_sections(other.settings)
+        if self.responses != other.responses:
+            changed.add('responses')
+        if self.category_setup != other.category_setup:
+            changed.add('category_setup')
+        return changed
+
+
+def _load_json(filename: str):
+    try:
+        with open(filename, encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        raise ConfigError(f'Could not find the file {filename}.') from None
+    except json.JSONDecodeError as error:
+        raise ConfigError(f'{filename} is not valid JSON: {error}') from None
+
+
+def parse_settings(data: dict, filename: str = 'settings.json') -> Settings:
+    reader = _Reader(filename)
+
+    debug = reader.section(data, 'debug', '')
+    doorbell = reader.section(data, 'doorbell', '')
+    seniority_badge = reader.section(data, 'seniority_badge', '')
+    metrics = reader.section(data, 'metrics', '', required=False)
+
+    # The invites used to be a list of entries, but are now an object with
+    # a name for each entry. Both are accepted.
+    invites = data.get('invites', {}) if isinstance(data, dict) else {}
+    if isinstance(invites, dict):
+        invite_entries = [(f'invites.{name}.', entry)
+                          for name, entry in invites.items()]
+    elif isinstance(invites, list):
+        invite_entries = [(f'invites[{i}].', entry)
+                          for i, entry in enumerate(invites)]
+    else:
+        reader.problems.append('invites should be dict or list, not'
+                               f' {type(invites).__name__}.')
+        invite_entries = []
+
+    settings = Settings(
+        discord_token=reader.value(data, 'discord_token', str, ''),
+        debug=DebugSettings(
+            status_channel=reader.value(
+                debug, 'status_channel', str, 'debug.'),
+            log_file=reader.value(debug, 'log_file', str, 'debug.', ''),
+            trace_file=reader.value(debug, 'trace_file', str, 'debug.', ''),
+            startup_profile_file=reader.value(
+                debug, 'startup_profile_file', str, 'debug.', '')),
+        invites=tuple(
+            InviteRole(channel=reader.value(entry, 'channel', str, path),
+                       role=reader.value(entry, 'role', str, path))
+            for path, entry in invite_entries),
+        doorbell=DoorbellSettings(
+            pin=reader.value(doorbell, 'pin', int, 'doorbell.'),
+            channel=reader.value(doorbell, 'channel', str, 'doorbell.'),
+            allowed_user_role=reader.value(
+                doorbell, 'allowed_user_role', str, 'doorbell.', ''),
+            cooldown=reader.value(
+                doorbell, 'cooldown', float, 'doorbell.', 2.0)),
+        seniority_badge=RoleAffixes(
+            year_prefix=reader.value(
+                seniority_badge, 'year_role_prefix', str, 'seniority_badge.'),
+            badge_prefix=reader.value(
+                seniority_badge, 'badge_role_prefix', str,
+                'seniority_badge.'),
+            badge_suffix=reader.value(
+                seniority_badge, 'badge_role_suffix', str,
+                'seniority_badge.')),
+        metrics=MetricsSettings(
+            host=reader.value(metrics, 'host', str, 'metrics.', '127.0.0.1'),
+            port=reader.value(metrics, 'port', int, 'metrics.', 0)),
+        state_file=reader.value(
+            data, 'state_file', str, '', 'house_robot.db'),
+        sharded=reader.value(data, 'sharded', bool, '', False),
+        member_cache=reader.value(data, 'member_cache', bool, '', True),
+        guild_startup_timeout=reader.value(
+            data, 'guild_startup_timeout', float, '', 600.0),
+        config_reload_interval=reader.value(
+            data, 'config_reload_interval', float, '', 5.0))
+
+    if not settings.discord_token:
+        reader.problems.append('discord_token is empty.')
+    if settings.guild_startup_timeout <= 0:
+        reader.problems.append('guild_startup_timeout should be positive.')
+    reader.raise_problems()
+    return settings
+
+
+def parse_responses(data: dict, filename: str = 'responses.json'
+                    ) -> DoorbellResponses:
+    reader = _Reader(filename)
+    responses = DoorbellResponses(
+        ok=reader.value(data, 'ok', str, ''),
+        invalid_role=reader.value(data, 'invalidRole', str, ''))
+    reader.raise_problems()
+    return responses
+
+
+def parse_category_setup(data: dict, filename: str = 'category_setup.json'
+                         ) -> CategorySetup:
+    reader = _Reader(filename)
+    channels = []
+    for i, channel in enumerate(reader.value(data, 'channels', list, '', [])):
+        path = f'channels[{i}].'
+        permissions = []
+        for j, permission in enumerate(
+                reader.value(channel, 'permissions', list, path, [])):
+            permission_path = f'{path}permissions[{j}].'
+            add = tuple(reader.value(permission, 'add', list, permission_path,
+                                     []))
+            remove = tuple(reader.value(permission, 'remove', list,
+                                        permission_path, []))
+            # Typos would otherwise only show up when setting up a year.
+            for name in add + remove:
+                if name not in Permissions.VALID_FLAGS:
+                    reader.problems.append(
+                        f'{permission_path[:-1]} has the unknown permission'
+                        f' {name!r}.')
+            permissions.append(ChannelPermissions(
+                role=reader.value(permission, 'role', str, permission_path),
+                add=add, remove=remove))
+        channels.append(ChannelSetup(
+            name=reader.value(channel, 'name', str, path),
+            topic=reader.value(channel, 'topic', str, path, ''),
+            permissions=tuple(permissions)))
+    reader.raise_problems()
+    return CategorySetup(channels=tuple(channels))
+
+
+# Called with the old and new config and the names of the changed sections.
+ConfigListener = Callable[[Config, Config, set[str]], Awaitable[None]]
+
+
+class ConfigWatcher:
+    """Holds the current config and reloads it when a file changes.
+
+    The files are checked by modification time. A new config is only used if
+    all files are valid, and replaces the old one in a single assignment, so
+    readers always see a consistent config. Read `config` once per task rather
+    than keeping it.
+    """
+
+    def __init__(self, settings_filename: str = 'settings.json',
+                 responses_filename: str = 'responses.json',
+                 category_setup_filename: str = 'category_setup.json'):
+        self.settings_filename = settings_filename
+        self.responses_filename = responses_filename
+        self.category_setup_filename = category_setup_filename
+        self.listeners: list[ConfigListener] = []
+        self.reloads = 0
+        self._mtimes = self._get_mtimes()
+        self.config = self._load()
+
+    def _get_mtimes(self) -> tuple[int|None, ...]:
+        mtimes = []
+        for filename in (self.settings_filename, self.responses_filename,
+                         self.category_setup_filename):
+            try:
+                mtimes.append(os.stat(filename).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _load(self) -> Config:
+        category_setup = None
+        if os.path.exists(self.category_setup_filename):
+            category_setup = parse_category_setup(
+                _load_json(self.category_setup_filename),
+                self.category_setup_filename)
+        return Config(
+            settings=parse_settings(
+                _load_json(self.settings_filename), self.settings_filename),
+            responses=parse_responses(
+                _load_json(self.responses_filename), self.responses_filename),
+            category_setup=category_setup)
+
+    def add_listener(self, listener: ConfigListener):
+        self.listeners.append(listener)
+
+    async def reload_if_changed(self) -> set[str]:
+        """Reload the config if a file changed, and tell the listeners which
+        sections changed.
+
+        Raise ConfigError, and keep the old config, if a changed file is not
+        valid.
+        """
+        mtimes = self._get_mtimes()
+        if mtimes == self._mtimes:
+            return set()
+        # Don't try to load the same broken files again.
+        self._mtimes = mtimes
+        old_config = self.config
+        new_config = self._load()
+        changed = new_config.changed_sections(old_config)
+        if not changed:
+            return changed
+        self.config = new_config
+        self.reloads += 1
+        for listener in self.listeners:
+            await listener(old_config, new_config, changed)
+        return changed
+
+    async def watch(self, on_error: Callable[[Exception], Awaitable[None]]):
+        """Check the files for changes until cancelled.
+
+        `on_error` is called with every error, and the files are still checked
+        afterwards.
+        """
+        while interval := self.config.settings.config_reload_interval:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload_if_changed()
+            except ConfigError as error:
+                await on_error(error)
+            except Exception as error:
+                # E.g. a file that could not be read or a listener that
+                # failed. Reloading must not stop because of it.
+                traceback.print_exc()
+                await on_error(error)
@@ -1,38 +1,135 @@
-from asyncio import sleep
+import asyncio
+from collections import deque
+from datetime import datetime
+from time import monotonic, time
 
 from discord import Message
-# Dont load the GPIO library in debug mode. This allows developing without the
-# Raspberry Pi.
-if not __debug__:
-    from gpiozero import DigitalOutputDevice
-
-async def check_doorbell(message: Message, doorbell_settings: dict,
-                         doorbell_responses: dict):
-    # Ignore messages from other channels.
-    if message.channel.name != doorbell_settings['channel']:
-        return
-
-    # Only allow some members to ring the doorbell if there is a doorbell role
-    # specified.
-    author_roles = [role.name for role in message.author.roles]
-    allowed_user_role = doorbell_settings['allowed_user_role']
-    if allowed_user_role and not allowed_user_role in author_roles:
-        await message.channel.send(doorbell_responses['invalidRole'])
-        print(f'{message.author} tried to use the doorbell.')
-        return
 
+from config import DoorbellResponses
+
+
+class GpioPin:
+    """A real GPIO pin on the Raspberry Pi."""
+
+    def __init__(self, pin: int):
+        # Only load the GPIO library when it is used. This allows developing
+        # without the Raspberry Pi.
+        from gpiozero import DigitalOutputDevice
+        self.device = DigitalOutputDevice(pin)
+
+    def on(self):
+        self.device.on()
+
+    def off(self):
+        self.device.off()
+
+    def close(self):
+        self.device.close()
+
+
+class SimulatedPin:
+    """Stands in for a GPIO pin when not running on the Raspberry Pi.
+
+    Every pulse is recorded as the times it was turned on and off.
+    """
+
+    def __init__(self):
+        self.is_on = False
+        self.pulses: list[tuple[float, float]] = []
+        self._turned_on_at = 0.0
+
+    def on(self):
+        self.is_on = True
+        self._turned_on_at = monotonic()
+
+    def off(self):
+        if self.is_on:
+            self.pulses.append((self._turned_on_at, monotonic()))
+        self.is_on = False
+
+    def close(self):
+        self.off()
+
+
+def create_doorbell_pin(pin: int) -> GpioPin|SimulatedPin:
+    # Don't use the GPIO pins in debug mode.
     if __debug__:
+        return SimulatedPin()
+    return GpioPin(pin)
+
+
+class DoorbellController:
+    """Rings the doorbell by sending pulses on a pin.
+
+    The pin is kept open for as long as the controller lives. Rings requested
+    within `cooldown` seconds of the start of a pulse are merged into that
+    pulse, so that the doorbell rings once when several people ask at the same
+    time.
+    """
+
+    def __init__(self, pin: GpioPin|SimulatedPin, pulse_length: float = 0.5,
+                 cooldown: float = 2.0):
+        self.pin = pin
+        self.pulse_length = pulse_length
+        # Pulses must not overlap.
+        self.cooldown = max(cooldown, pulse_length)
+        self.pulses = 0
+        self.coalesced = 0
+        # Seconds from a ring being requested until the pin was turned on.
+        self.latencies: deque[float] = deque(maxlen=100)
+        self._pulse: asyncio.Future|None = None
+        self._pulse_started_at = 0.0
+
+    async def _send_pulse(self):
+        self.pin.on()
+        try:
+            await asyncio.sleep(self.pulse_length)
+        finally:
+            self.pin.off()
+
+    async def ring(self, requested_at: datetime|None = None) -> bool:
+        """Ring the doorbell and wait until the pulse is done.
+
+        Return True if a new pulse was sent, or False if the ring was merged
+        into a recent pulse.
+        """
+        if (self._pulse is not None
+                and monotonic() - self._pulse_started_at < self.cooldown):
+            self.coalesced += 1
+            await asyncio.shield(self._pulse)
+            return False
+
+        self._pulse_started_at = monotonic()
+        if requested_at is not None:
+            self.latencies.append(time() - requested_at.timestamp())
+        self._pulse = asyncio.ensure_future(self._send_pulse())
+        self.pulses += 1
+        # Don't cut the pulse short if the one waiting is cancelled.
+        await asyncio.shield(self._pulse)
+        return True
+
+    def close(self):
+        self.pin.close()
+
+
+async def refuse_doorbell(message: Message,
+                          doorbell_responses: DoorbellResponses):
+    """Tell a member without the doorbell role that they can't use it."""
+    await message.channel.send(doorbell_responses.invalid_role)
+    print(f'{message.author} tried to use the doorbell.')
+
+
+async def ring_doorbell(message: Message, doorbell_responses: DoorbellResponses,
+                        controller: DoorbellController):
+    """Ring the doorbell for a message in the doorbell channel."""
+    await controller.ring(requested_at=message.created_at)
+
+    if isinstance(controller.pin, SimulatedPin):
         text = 'Doorbell disabled in debug mode.'
         await message.channel.send(text)
         print(text)
     else:
-        # Toggle pin to ring door bell.
-        pin = DigitalOutputDevice(doorbell_settings['pin'])
-        pin.on()
-        await sleep(0.5)
-        pin.off()
-
         # Respond to the request to open the door by writing a message in the
         # same channel.
-        await message.channel.send(doorbell_responses['ok'])
+        await message.channel.send(doorbell_responses.ok)
         print(f'{message.author} used the doorbell.')
@@ -0,0 +1,105 @@
+import json
+from time import monotonic
+
+from discord import ChannelType, Guild, Invite, Member, Message
+
+
+class TraceRecorder:
+    """Writes the events the bot handles to a JSONL file, to be replayed with
+    `python -m benchmarks.replay`.
+
+    Every line is an object with the seconds since recording started in `t`
+    and the kind of record in `e`. Ids are replaced by small numbers in order
+    of appearance and invite codes by made up ones, and no names of members or
+    contents of messages are written, so the trace does not identify anyone.
+    Role and channel names are kept, since the bot looks them up by name.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'w', encoding='utf-8', buffering=1)
+        self._started_at = monotonic()
+        self._ids: dict[int, int] = {}
+        self._codes: dict[str, str] = {}
+        # Only events of guilds whose initial state was written can be
+        # replayed.
+        self._guild_ids: set[int] = set()
+
+    def _id(self, snowflake: int) -> int:
+        return self._ids.setdefault(snowflake, len(self._ids) + 1)
+
+    def _code(self, code: str) -> str:
+        return self._codes.setdefault(code, f'i{len(self._codes) + 1}')
+
+    def _role_ids(self, member: Member) -> list[int]:
+        # Without @everyone, which every member has.
+        return [self._id(role.id) for role in member.roles
+                if role.id != member.guild.id]
+
+    def _write(self, kind: str, **fields):
+        record = {'t': round(monotonic() - self._started_at, 3), 'e': kind}
+        record.update(fields)
+        self._file.write(json.dumps(
+            record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def record_guild(self, guild: Guild):
+        """Write the roles, channels and members of a guild."""
+        self._guild_ids.add(guild.id)
+        channels = [
+            (self._id(channel.id), channel.name,
+             'category' if channel.type == ChannelType.category else 'text',
+             self._id(channel.category_id) if channel.category_id else None,
+             channel.position)
+            for channel in guild.channels
+            if channel.type in (ChannelType.category, ChannelType.text)]
+        self._write(
+            'guild', g=self._id(guild.id),
+            roles=[(self._id(role.id), role.name, role.position)
+                   for role in guild.roles],
+            channels=channels,
+            members=[(self._id(member.id), self._role_ids(member))
+                     for member in guild.members])
+
+    def record_invites(self, guild: Guild, invites: list[Invite]):
+        """Write the uses of the invites of a guild, as fetched."""
+        if guild.id not in self._guild_ids:
+            return
+        self._write('invites', g=self._id(guild.id), invites=[
+            (self._code(invite.code), self._id(invite.channel.id),
+             invite.uses or 0, invite.max_uses or 0)
+            for invite in invites])
+
+    def record_event(self, event: str, args: tuple):
+        """Write a gateway event, if it is one the trace keeps."""
+        if event == 'member_join':
+            member, = args
+            if member.guild.id in self._guild_ids:
+                self._write('member_join', g=self._id(member.guild.id),
+                            m=self._id(member.id), r=self._role_ids(member))
+        elif event == 'member_update':
+            before, after = args
+            if after.guild.id in self._guild_ids:
+                self._write('member_update', g=self._id(after.guild.id),
+                            m=self._id(after.id), b=self._role_ids(before),
+                            r=self._role_ids(after))
+        elif event == 'message':
+            message: Message = args[0]
+            if message.guild and message.guild.id in self._guild_ids:
+                author = message.author
+                self._write(
+                    'message', g=self._id(message.guild.id),
+                    c=self._id(message.channel.id), m=self._id(author.id),
+                    r=self._role_ids(author) if isinstance(author, Member)
+                    else [],
+                    bot=author.bot)
+        elif event in ('invite_create', 'invite_delete'):
+            invite: Invite = args[0]
+            if invite.guild and invite.guild.id in self._guild_ids:
+                self._write(event, g=self._id(invite.guild.id),
+                            i=self._code(invite.code),
+                            c=self._id(invite.channel.id),
+                            uses=invite.uses or 0,
+                            max_uses=invite.max_uses or 0)
+
+    def close(self):
+        self._file.close()
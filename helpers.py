@@ -1,38 +1,157 @@
-from discord import CategoryChannel, Guild, Role, TextChannel
+from bisect import bisect_left, insort
+
+from discord import CategoryChannel, ChannelType, Guild, Role, TextChannel
+from discord.abc import GuildChannel
+
+
+class _NameIndex:
+    """Objects grouped by exact name, with the names kept sorted so that all
+    names starting with a prefix can be found with a binary search."""
+
+    def __init__(self, sort_key):
+        self.sort_key = sort_key
+        self.by_name: dict[str, list] = {}
+        self.sorted_names: list[str] = []
+
+    def add(self, item):
+        items = self.by_name.setdefault(item.name, [])
+        if not items:
+            insort(self.sorted_names, item.name)
+        if all(other.id != item.id for other in items):
+            items.append(item)
+
+    def remove(self, name: str, item_id: int):
+        items = self.by_name.get(name)
+        if items is None:
+            return
+        items[:] = [item for item in items if item.id != item_id]
+        if not items:
+            del self.by_name[name]
+            del self.sorted_names[bisect_left(self.sorted_names, name)]
+
+    def first_by_name(self, name: str, predicate=None):
+        return min(
+            (item for item in self.by_name.get(name, ())
+                if predicate is None or predicate(item)),
+            key=self.sort_key, default=None)
+
+    def first_by_prefix(self, prefix: str, predicate=None):
+        candidates = []
+        i = bisect_left(self.sorted_names, prefix)
+        while (i < len(self.sorted_names)
+               and self.sorted_names[i].startswith(prefix)):
+            candidates.extend(
+                item for item in self.by_name[self.sorted_names[i]]
+                if predicate is None or predicate(item))
+            i += 1
+        return min(candidates, key=self.sort_key, default=None)
+
+
+def _channel_sort_key(channel: GuildChannel):
+    # Same order as Guild.categories and Guild.text_channels.
+    return (channel.position, channel.id)
+
+
+# The types of the channels in Guild.text_channels.
+_TEXT_CHANNEL_TYPES = (ChannelType.text, ChannelType.news)
+
+
+class GuildIndex:
+    """Name lookups of the roles and channels of a guild.
+
+    Roles and channels are stored as the objects cached by discord.py, which
+    are updated in place, so positions are always current. Only renames,
+    creations and deletions have to be applied to the index.
+    """
+
+    def __init__(self, guild: Guild):
+        self.guild = guild
+        # Roles compare by position, which is the order of Guild.roles.
+        self.roles = _NameIndex(sort_key=lambda role: role)
+        self.categories = _NameIndex(sort_key=_channel_sort_key)
+        self.text_channels = _NameIndex(sort_key=_channel_sort_key)
+        for role in guild.roles:
+            self.roles.add(role)
+        for channel in guild.channels:
+            self.add_channel(channel)
+
+    def add_role(self, role: Role):
+        self.roles.add(role)
+
+    def remove_role(self, role: Role):
+        self.roles.remove(role.name, role.id)
+
+    def update_role(self, role_before: Role, role_after: Role):
+        if role_before.name != role_after.name:
+            self.roles.remove(role_before.name, role_before.id)
+        self.roles.add(role_after)
+
+    # Channels are told apart by type rather than class, like
+    # Guild.text_channels does, so that stand-ins can be used in benchmarks.
+    def add_channel(self, channel: GuildChannel):
+        if channel.type == ChannelType.category:
+            self.categories.add(channel)
+        elif channel.type in _TEXT_CHANNEL_TYPES:
+            self.text_channels.add(channel)
+
+    def remove_channel(self, channel: GuildChannel):
+        if channel.type == ChannelType.category:
+            self.categories.remove(channel.name, channel.id)
+        elif channel.type in _TEXT_CHANNEL_TYPES:
+            self.text_channels.remove(channel.name, channel.id)
+
+    def update_channel(self, channel_before: GuildChannel,
+                       channel_after: GuildChannel):
+        if channel_before.name != channel_after.name:
+            self.remove_channel(channel_before)
+        self.add_channel(channel_after)
+
+
+_guild_indexes: dict[int, GuildIndex] = {}
+
+
+def get_guild_index(guild: Guild) -> GuildIndex:
+    """Get the index of the guild, building it if needed.
+
+    discord.py creates new guild objects after a reconnect, so the index is
+    rebuilt if it was built from another guild object.
+    """
+    index = _guild_indexes.get(guild.id)
+    if index is None or index.guild is not guild:
+        index = _guild_indexes[guild.id] = GuildIndex(guild)
+    return index
+
+
+def forget_guild(guild: Guild):
+    """Drop the index of a guild the bot is no longer part of."""
+    _guild_indexes.pop(guild.id, None)
 
 
 def get_role_by_name(guild: Guild, name: str) -> Role|None:
-    return next(
-        (role for role in guild.roles if role.name == name),
-        None)
+    return get_guild_index(guild).roles.first_by_name(name)
 
 
 def get_first_role_by_prefix(
     guild: Guild, prefix: str, ignored_role: Role|None = None
 ) -> Role|None:
-    return next(
-        (role for role in guild.roles
-            if role.name.startswith(prefix) and role != ignored_role),
-        None)
+    return get_guild_index(guild).roles.first_by_prefix(
+        prefix, lambda role: role != ignored_role)
 
 
 def get_category_by_name(guild: Guild, name: str) -> CategoryChannel|None:
-    return next(
-        (category for category in guild.categories if category.name == name),
-        None)
+    return get_guild_index(guild).categories.first_by_name(name)
 
 def get_first_category_by_prefix(
     guild: Guild, prefix: str, ignored_category: CategoryChannel|None = None
 ) -> CategoryChannel|None:
-    return next(
-        (category for category in guild.categories
-            if category.name.startswith(prefix) and category != ignored_category),
-        None)
+    return get_guild_index(guild).categories.first_by_prefix(
+        prefix, lambda category: category != ignored_category)
 
 
 def get_text_channel_by_name(
     parent: Guild|CategoryChannel, name: str
 ) -> TextChannel|None:
-    return next(
-        (channel for channel in parent.text_channels if channel.name == name),
-        None)
+    if getattr(parent, 'type', None) == ChannelType.category:
+        return get_guild_index(parent.guild).text_channels.first_by_name(
+            name, lambda channel: channel.category_id == parent.id)
+    return get_guild_index(parent).text_channels.first_by_name(name)
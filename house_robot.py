@@ -1,63 +1,276 @@
+import asyncio
+from hashlib import sha256
+from io import BytesIO
 import json
-
-from discord import app_commands, Client, Interaction, Member, Message, \
-    PermissionOverwrite
-
-from bot_logging import log
-from doorbell import check_doorbell
-from helpers import get_role_by_name, get_text_channel_by_name
-from invites import apply_invite_role, get_invite_uses
-from seniority_badge import RoleAffixes, adjust_badge_roles
-from public_category import create_channel_overwrites, create_or_update_text_channel, create_year_category, create_year_role
+from time import monotonic
+
+from discord import app_commands, Attachment, AutoShardedClient, Client, File, Guild, \
+    Interaction, Invite, Member, Message, Role
+from discord.abc import GuildChannel
+
+from badge_recompute import BadgeRecompute, ProgressMessage, \
+    format_badge_changes, get_checkpoint_key
+from bot_logging import flush_logs, log, log_local
+from config import RESTART_SECTIONS, Config, ConfigError, ConfigWatcher
+from doorbell import DoorbellController, create_doorbell_pin, \
+    refuse_doorbell, ring_doorbell
+from helpers import forget_guild, get_guild_index, get_role_by_name, \
+    get_text_channel_by_name
+from metrics import instrument_http, metrics, start_metrics_server, timed, \
+    track_rate_limits
+from member_updates import MemberUpdateStats, \
+    dispatch_uncached_member_updates, should_adjust_badge
+from invites import InviteTracker, apply_invite_roles, get_invite_roles
+from state_store import StateStore
+from supervisor import ConnectionMetrics
+from seniority_badge import BadgeChange, RoleAffixes, adjust_badge_roles, \
+    apply_badge_change, compute_badge_change, get_badge_ladder, \
+    invalidate_badge_ladder, validate_badge_ladder
+from reconcile import get_state_after_change, reconcile_badges
+from role_writes import role_writes
+from router import MessageRouter
+from startup_profile import startup_profiler
 
 
 class HouseRobot(Client):
     """Custom client."""
 
-    def __init__(self, settings: dict, doorbell_responses: dict,
-                 *args, **kwargs):
+    def __init__(self, config_watcher: ConfigWatcher, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.settings = settings
-        self.doorbell_responses = doorbell_responses
+        # The config is reloaded when the files change.
+        self.config_watcher = config_watcher
+        self.config_watcher.add_listener(self.on_config_change)
+        self.config_task: asyncio.Task|None = None
+        settings = self.config.settings
 
-        self.role_affixes = RoleAffixes(
-            settings['seniority_badge']['year_role_prefix'],
-            settings['seniority_badge']['badge_role_prefix'],
-            settings['seniority_badge']['badge_role_suffix'])
+        self.doorbell = DoorbellController(
+            create_doorbell_pin(settings.doorbell.pin),
+            cooldown=settings.doorbell.cooldown)
+        self.message_router = MessageRouter()
         self.status_channel = {}
-        self.invite_uses = {}
+        # What was known when the bot last ran, to speed up restarts.
+        self.store = StateStore(settings.state_file)
+        self.invite_trackers: dict[int, InviteTracker] = {}
+        self.badge_recomputes: dict[int, asyncio.Task] = {}
+
+        self.connection_metrics = ConnectionMetrics()
+        self.member_update_stats = MemberUpdateStats()
+
+        self.metrics_server = None
+
+        # Records the events handled, to replay them offline.
+        self.trace_recorder = None
+        if settings.debug.trace_file:
+            # Only needed when recording.
+            from event_trace import TraceRecorder
+            self.trace_recorder = TraceRecorder(settings.debug.trace_file)
 
         self.tree = app_commands.CommandTree(self)
+        # on_ready is called again when the connection can't be resumed.
+        self.has_been_ready = False
+
+
+    @property
+    def config(self) -> Config:
+        return self.config_watcher.config
+
+
+    @property
+    def role_affixes(self) -> RoleAffixes:
+        return self.config.settings.seniority_badge
 
 
+    async def setup_hook(self):
+        # Measure the requests made to Discord.
+        instrument_http(self.http)
+        track_rate_limits()
+        # Member updates are needed even without the member cache.
+        dispatch_uncached_member_updates(self._connection)
+        metrics_settings = self.config.settings.metrics
+        if metrics_settings.port:
+            self.metrics_server = await start_metrics_server(
+                metrics_settings.host, metrics_settings.port)
+        self.config_task = asyncio.create_task(
+            self.config_watcher.watch(self.on_config_error))
+        # Copied to every guild when its commands are synced.
+        self.register_commands()
+
+
+    async def login(self, token: str):
+        with startup_profiler.phase('login'):
+            await super().login(token)
+        startup_profiler.start('gateway ready')
+
+
+    @timed('on_ready')
     async def on_ready(self):
         print(f'{self.user} has connected to Discord!')
+        self.connection_metrics.mark_ready()
+        print(f'Connection: {self.connection_metrics}')
+        first_ready = not self.has_been_ready
+        self.has_been_ready = True
+        startup_profiler.end_named('gateway ready')
+
+        # Start every guild at the same time, so that a slow or broken guild
+        # doesn't hold up the others. Guilds started before the connection
+        # was lost only catch up on what was missed.
+        await asyncio.gather(*(
+            self.start_guild(guild, catch_up=not first_ready
+                             and guild.id in self.invite_trackers)
+            for guild in self.guilds))
+
+        if first_ready:
+            profile_file = self.config.settings.debug.startup_profile_file
+            for line in startup_profiler.finish(profile_file):
+                log_local(line)
+
+
+    async def start_guild(self, guild: Guild, catch_up: bool = False):
+        """Run the startup of a guild, stopping it if it fails or takes too
+        long."""
+        timeout = self.config.settings.guild_startup_timeout
+        start = self._catch_up_guild if catch_up else self._start_guild
+        try:
+            with startup_profiler.phase('guild startup', guild.name):
+                await asyncio.wait_for(start(guild), timeout)
+        except Exception as error:
+            message = f'Startup of {guild.name} failed: {error!r}'
+            if isinstance(error, asyncio.TimeoutError):
+                message = f'Startup of {guild.name} took more than {timeout} s.'
+            status_channel = self.status_channel.get(guild.id)
+            if status_channel:
+                await log(status_channel, message)
+            else:
+                print(message)
 
-        for guild in self.guilds:
-            # Get channel used to log status messages.
-            try:
-                self.status_channel[guild.id] = next(
-                    channel for channel in guild.channels
-                    if channel.name == self.settings['debug']['status_channel'])
-            except StopIteration:
-                raise RuntimeError(f"Status channel {self.settings['debug']['status_channel']} not found.")
-            status_channel = self.status_channel[guild.id]
 
-            await log(status_channel, "I'm online!")
+    async def _start_guild(self, guild: Guild):
+        # Get channel used to log status messages.
+        status_channel = self.find_status_channel(guild)
+        self.status_channel[guild.id] = status_channel
+
+        await log(status_channel, "I'm online!")
+
+        await self.route_messages(guild)
 
+        if self.trace_recorder:
+            self.trace_recorder.record_guild(guild)
+        invite_tracker = InviteTracker(
+            guild, on_fetch=(self.trace_recorder.record_invites
+                      if self.trace_recorder else None))
+        self.invite_trackers[guild.id] = invite_tracker
+        with startup_profiler.phase('invite snapshot', guild.name):
+            # Not restored from the store, since the uses of members that
+            # joined while the bot was offline would be attributed to the
+            # next member.
             await log(status_channel, 'Storing invite uses...')
-            self.invite_uses[guild.id] = await get_invite_uses(guild)
+            await invite_tracker.snapshot()
             await log(status_channel, 'Done storing invite uses.')
 
-            await log(status_channel, 'Adjusting roles...')
-            for member in guild.members:
-                await adjust_badge_roles(member, self.role_affixes, status_channel)
-            await log(status_channel, 'Done adjusting roles.')
+        with startup_profiler.phase('badge reconcile', guild.name):
+            await self.reconcile_guild_badges(guild)
+
+        with startup_profiler.phase('command sync', guild.name):
+            await self.sync_guild_commands(guild)
+
+        await log(status_channel, "I'm ready!")
+
+
+    async def _catch_up_guild(self, guild: Guild):
+        """Process what was missed while the connection was lost.
+
+        discord.py replaces the guild and its channels after a new session,
+        so everything that refers to them is looked up again.
+        """
+        status_channel = self.find_status_channel(guild)
+        self.status_channel[guild.id] = status_channel
+
+        await log(status_channel, "I'm back online! Catching up...")
+
+        await self.route_messages(guild)
+
+        # Invites may have been created, used or deleted during the outage.
+        invite_tracker = self.invite_trackers[guild.id]
+        invite_tracker.guild = guild
+        await invite_tracker.snapshot()
+
+        # Only the members whose roles changed since their badge was stored
+        # are checked.
+        await self.reconcile_guild_badges(guild)
+
+        await self.sync_guild_commands(guild)
+
+        await log(status_channel, 'Done catching up.')
+
+
+    async def reconcile_guild_badges(self, guild: Guild):
+        """Give every member of the guild the correct seniority badge."""
+        status_channel = self.status_channel[guild.id]
+        await log(status_channel, 'Adjusting roles...')
+        # Check the badge roles once instead of trusting their order every
+        # time a badge is chosen.
+        invalidate_badge_ladder(guild)
+        ladder = get_badge_ladder(guild, self.role_affixes)
+        for problem in validate_badge_ladder(ladder, self.role_affixes):
+            await log(status_channel, f'Warning: {problem}')
+
+        # An interrupted recompute checks every member anyway.
+        if self.store.get_meta(get_checkpoint_key(guild.id)) is not None:
+            await log(status_channel, 'Resuming the interrupted badge recompute.')
+            self.start_badge_recompute(guild)
+            return
+
+        report = await reconcile_badges(
+            guild, self.role_affixes, status_channel, store=self.store,
+            fetch_members=not self.config.settings.member_cache)
+        await log(status_channel, f'Done adjusting roles: {report}')
 
-        @self.tree.command(guilds=self.guilds)
+
+    def create_badge_recompute(self, guild: Guild) -> BadgeRecompute:
+        return BadgeRecompute(
+            guild, self.role_affixes, self.status_channel[guild.id],
+            self.store, fetch_members=not self.config.settings.member_cache)
+
+
+    def start_badge_recompute(self, guild: Guild) -> bool:
+        """Start checking the badge of every member of the guild in the
+        background, unless it is already being done."""
+        if guild.id in self.badge_recomputes:
+            return False
+        recompute = self.create_badge_recompute(guild)
+        status_channel = self.status_channel[guild.id]
+        progress_message = ProgressMessage(status_channel, 'Recomputing badges')
+
+        async def run():
+            try:
+                await recompute.run(progress_message.update)
+            except Exception as error:
+                # The checkpoint is kept, so it can be resumed.
+                await log(status_channel, f'Badge recompute failed: {error!r}')
+            finally:
+                del self.badge_recomputes[guild.id]
+
+        self.badge_recomputes[guild.id] = asyncio.create_task(run())
+        return True
+
+
+    def find_status_channel(self, guild: Guild) -> GuildChannel:
+        name = self.config.settings.debug.status_channel
+        try:
+            return next(
+                channel for channel in guild.channels if channel.name == name)
+        except StopIteration:
+            raise RuntimeError(f'Status channel {name} not found.') from None
+
+
+    def register_commands(self):
+        """Add the slash commands to the command tree."""
+        @self.tree.command()
         @app_commands.checks.has_permissions(administrator=True)
-        async def setup_channels(interaction: Interaction, year: int):
+        @timed('setup_channels')
+        async def setup_channels(interaction: Interaction, year: int,
+                                 dry_run: bool = False):
             """Creates role(s) and public channels for the specified year.
 
             Each year a new category with channels is used for all public
@@ -65,17 +278,21 @@ class HouseRobot(Client):
             year-specific role has access to them.
 
             This command sets up a new category with the required channels, and
-            creates the required role(s) specific to that year.
+            creates the required role(s) specific to that year. Only what
+            differs from the setup is changed.
 
             Parameters
             ----------
             year: int
                 competition year
+            dry_run: bool
+                only show what would be changed
             """
 
             guild = interaction.guild
             status_channel = self.status_channel[guild.id]
-            setup_filename = 'category_setup.json'
+            setup_filename = self.config_watcher.category_setup_filename
+            category_setup = self.config.category_setup
 
             await interaction.response.send_message((
                 f'Setting up the competition for year {year}.'
@@ -90,121 +307,468 @@ class HouseRobot(Client):
                 await log(status_channel, message)
                 return
 
-            # Create the year-specific competitor role if it doesn't exist.
-            year_specific_role_prefix = 'Tävlande'
-            year_specific_role = await create_year_role(
-                guild, status_channel, year, year_specific_role_prefix)
-
-            # Create overwrites for the category that can be synched with its channels.
-            category_overwrites = {
-                robot_group_role: PermissionOverwrite(
-                    view_channel=True, connect=True, send_messages=True, speak=True),
-                year_specific_role: PermissionOverwrite(
-                    view_channel=True, connect=True),
-                guild.default_role: PermissionOverwrite(
-                    view_channel=False, connect=False, send_messages=False, speak=False)
-            }
-
-            # Parse the category setup file into a dict.
-            try:
-                with open(setup_filename, encoding='utf-8') as json_file:
-                    setup_json = json.load(json_file)
-                    channels_json = setup_json['channels']
-            except FileNotFoundError:
+            # The category setup file was validated when it was loaded.
+            if category_setup is None:
                 message = f'Aborted: Could not find the file {setup_filename}.'
                 await log(status_channel, message)
                 return
-            except KeyError:
-                message = f'Aborted: The file {setup_filename} is missing required keys.'
-                await log(status_channel, message)
+
+            # The commands below are rarely used, so their modules are only
+            # loaded when they are.
+            from public_category import apply_setup_plan, plan_year_setup
+            start = monotonic()
+            plan = await plan_year_setup(
+                guild, status_channel, year, robot_group_role, category_setup.channels,
+                year_role_prefix='Tävlande',
+                year_category_prefix='Robottävlingen')
+            # Abort if an error occured.
+            if plan is None:
+                return
+            planned = monotonic()
+
+            if dry_run:
+                await interaction.followup.send(
+                    f'Dry run, {len(plan.operations)} operations planned'
+                    f' in {planned - start:.2f} s:',
+                    file=File(BytesIO(str(plan).encode()),
+                              filename=f'setup_{year}.txt'))
+                await log(status_channel, f'Dry run of the setup for year {year} done.')
                 return
 
-            # Create the category if it doesn't exist.
-            category = await create_year_category(
-                guild, status_channel, year, 'Robottävlingen',
-                category_overwrites)
-
-            # Add channels to category.
-            for channel_json in channels_json:
-                channel_name: str = channel_json['name']
-                channel_topic: str = channel_json['topic']
-                channel_permissions_json: dict = channel_json['permissions']
-                channel_overwrites = await create_channel_overwrites(
-                    guild,
-                    status_channel,
-                    category_overwrites,
-                    channel_permissions_json,
-                    year_specific_role,
-                    year_specific_role_prefix
-                    )
-                # Abort if an error occured.
-                if channel_overwrites is None:
-                    return
-
-                # Create channel, or update already existing one.
-                channel = await create_or_update_text_channel(
-                    category,
-                    status_channel,
-                    channel_name,
-                    channel_topic,
-                    channel_overwrites)
+            await apply_setup_plan(plan)
+            applied = monotonic()
 
+            await interaction.followup.send(
+                f'Applied {len(plan.operations)} operations in'
+                f' {applied - planned:.2f} s (planned in'
+                f' {planned - start:.2f} s).')
             await log(
                 status_channel,
                 f'Done setting up the competition for year {year}.')
 
-        await self.sync_commands()
+        @self.tree.command()
+        @app_commands.checks.has_permissions(administrator=True)
+        @timed('recompute_badges')
+        async def recompute_badges(interaction: Interaction,
+                                   dry_run: bool = False):
+            """Checks the seniority badge of every member.
 
-        await log(status_channel, "I'm ready!")
+            The badges are recomputed in the background, and the progress is
+            shown in the status channel. An interrupted recompute continues
+            where it stopped when the bot restarts.
 
+            Parameters
+            ----------
+            dry_run: bool
+                only list the changes that would be made
+            """
+            guild = interaction.guild
+            status_channel = self.status_channel[guild.id]
 
+            if dry_run:
+                await interaction.response.defer(thinking=True)
+                start = monotonic()
+                changes = await self.create_badge_recompute(guild).dry_run()
+                await interaction.followup.send(
+                    f'Dry run, {len(changes)} members would change'
+                    f' (checked in {monotonic() - start:.2f} s):',
+                    file=File(BytesIO(format_badge_changes(changes).encode()),
+                              filename='badge_changes.txt'))
+                return
+
+            if not self.start_badge_recompute(guild):
+                await interaction.response.send_message(
+                    'The badges are already being recomputed.', ephemeral=True)
+                return
+            await interaction.response.send_message(
+                f'Recomputing badges. Check the progress in {status_channel.mention}.')
+
+        @self.tree.command()
+        @app_commands.checks.has_permissions(administrator=True)
+        @timed('assign_year_role')
+        async def assign_year_role(interaction: Interaction,
+                                   roster: Attachment, year: int):
+            """Gives the competitors of a roster the role of the year.
+
+            The roster is a CSV file with a member id, mention or username
+            first on every row. The seniority badge of every member is updated
+            in the same request as the year role.
+
+            Parameters
+            ----------
+            roster: Attachment
+                CSV file with a member on every row
+            year: int
+                competition year
+            """
+            guild = interaction.guild
+            status_channel = self.status_channel[guild.id]
+            await interaction.response.defer(thinking=True)
+
+            from public_category import create_year_role
+            from roster import RosterReport, assign_roster, parse_roster, \
+                resolve_roster
+            rows = parse_roster(await roster.read())
+            report = RosterReport(rows)
+            start = monotonic()
+            await resolve_roster(guild, rows,
+                                 cache=self.config.settings.member_cache)
+            report.resolve_time = monotonic() - start
+
+            year_role = await create_year_role(
+                guild, status_channel, year, year_role_prefix='Tävlande')
+            ladder = get_badge_ladder(guild, self.role_affixes)
+            start = monotonic()
+            report.writes = await assign_roster(rows, year_role, ladder)
+            report.write_time = monotonic() - start
+
+            await log(status_channel, f'Roster for {year_role.name}: {report}')
+            await interaction.followup.send(
+                str(report),
+                file=File(BytesIO(report.to_csv().encode()),
+                          filename=f'roster_{year}.csv'))
+
+        @self.tree.command()
+        @app_commands.checks.has_permissions(administrator=True)
+        @timed('rollover')
+        async def rollover(interaction: Interaction, year: int,
+                           dry_run: bool = False):
+            """Orders the year roles and archives the categories of past years.
+
+            The categories of the years before the specified year are made
+            read only and moved to the bottom.
+
+            Parameters
+            ----------
+            year: int
+                competition year
+            dry_run: bool
+                only show what would be changed
+            """
+            guild = interaction.guild
+            status_channel = self.status_channel[guild.id]
+            await interaction.response.defer(thinking=True)
+            from rollover import roll_over_year
+            report = await roll_over_year(
+                guild, status_channel, year, year_role_prefix='Tävlande',
+                year_category_prefix='Robottävlingen', dry_run=dry_run)
+            if dry_run:
+                await interaction.followup.send(f'Dry run: {report}')
+                return
+            await log(status_channel, f'Rollover to {year} done: {report}')
+            await interaction.followup.send(f'Rollover to {year} done: {report}')
+
+        @self.tree.command()
+        @app_commands.checks.has_permissions(administrator=True)
+        async def stats(interaction: Interaction):
+            """Shows how the bot performs."""
+            await interaction.response.send_message(
+                self.get_stats_text()[:2000], ephemeral=True)
+
+
+    async def on_disconnect(self):
+        self.connection_metrics.mark_disconnected()
+
+
+    async def on_resumed(self):
+        self.connection_metrics.mark_connected()
+
+
+    @timed('on_member_join')
     async def on_member_join(self, member: Member):
         guild = member.guild
+        if guild.id not in self.invite_trackers:
+            # The startup of the guild failed or is not done.
+            return
         status_channel = self.status_channel[guild.id]
 
         await log(status_channel, f'{member.name} joined the server.')
 
-        for invite in await guild.invites():
-            invite_uses_before = self.invite_uses[guild.id].get(invite.code, 0)
-
-            # Check if the user joined via this invite.
-            if invite.uses > invite_uses_before:
-                await log(status_channel, f'{member.name} joined using invite {invite.code}')
-                await apply_invite_role(member=member, invite=invite,
-                                  invite_settings=self.settings['invites'],
-                                  status_channel=status_channel)
-                # Make sure new competitors get a seniority badge.
-                await adjust_badge_roles(member, self.role_affixes, status_channel)
-                # The invite was found. No need to check the rest.
-                break
-
-        # Update the invite uses for the next member join event.
-        self.invite_uses[guild.id] = await get_invite_uses(guild)
-
+        attribution = await self.invite_trackers[guild.id].attribute(member)
+        invite = attribution.invite
+        confidence = attribution.confidence.value
+        if invite is None:
+            await log(status_channel, f'Could not tell which invite {member.name} used ({confidence}).')
+            return
 
+        await log(status_channel, f'{member.name} joined using invite {invite.code} ({confidence})')
+        invite_roles = await get_invite_roles(
+            guild, invite, self.config.settings.invites, status_channel)
+        # Make sure new competitors get a seniority badge. The update that
+        # adds the year role is an echo of the bot's own write and is not
+        # handled, so the badge is decided with the invite roles included.
+        role_ids = ({role.id for role in member.roles}
+                    | {role.id for role in invite_roles})
+        change = compute_badge_change(member, self.role_affixes,
+                                      role_ids=role_ids)
+        # Requested together, so that the roles are written with a single
+        # request.
+        await asyncio.gather(
+            apply_invite_roles(member, invite_roles, status_channel),
+            *([apply_badge_change(change, status_channel)] if change else []))
+        if change:
+            self.save_badge_state(change, role_ids)
+
+
+    async def on_invite_create(self, invite: Invite):
+        invite_tracker = self.invite_trackers.get(invite.guild.id)
+        if invite_tracker:
+            invite_tracker.invite_created(invite)
+
+
+    async def on_invite_delete(self, invite: Invite):
+        invite_tracker = self.invite_trackers.get(invite.guild.id)
+        if invite_tracker:
+            invite_tracker.invite_deleted(invite)
+
+
+    @timed('on_member_update')
     async def on_member_update(self, member_before: Member, member_after: Member):
         guild = member_after.guild
-        status_channel = self.status_channel[guild.id]
+        status_channel = self.status_channel.get(guild.id)
+        if not status_channel:
+            # The startup of the guild failed or is not done.
+            return
 
-        if member_before.roles != member_after.roles:
+        ladder = get_badge_ladder(guild, self.role_affixes)
+        if should_adjust_badge(member_before, member_after,
+                               ladder.badge_related_role_ids,
+                               self.member_update_stats):
             # It is possible the seniority badge need to be updated.
-            await adjust_badge_roles(member_after, self.role_affixes, status_channel)
+            change = await adjust_badge_roles(member_after, self.role_affixes, status_channel)
+            if change:
+                self.save_badge_state(change)
+
+
+    @timed('on_uncached_member_update')
+    async def on_uncached_member_update(self, guild: Guild, member_id: int,
+                                        role_ids: frozenset[int]):
+        """Handle a member update without the member cache.
+
+        The roles before the update are not known, so the badge is checked
+        from the roles after it. Only members whose badge is wrong are fetched.
+        """
+        status_channel = self.status_channel.get(guild.id)
+        if not status_channel:
+            # The startup of the guild failed or is not done.
+            return
+
+        ladder = get_badge_ladder(guild, self.role_affixes)
+        badge_id_to_add, badge_ids_to_remove = ladder.decide(role_ids)
+        if badge_id_to_add is None and not badge_ids_to_remove:
+            return
+        member = await guild.fetch_member(member_id)
+        change = await adjust_badge_roles(member, self.role_affixes, status_channel)
+        if change:
+            self.save_badge_state(change)
+
 
+    def save_badge_state(self, change: BadgeChange,
+                         role_ids: set[int]|None = None):
+        """Store the state a live badge write left the member in, so that the
+        catch-up after a re-ready doesn't check the member again."""
+        guild = change.member.guild
+        ladder = get_badge_ladder(guild, self.role_affixes)
+        self.store.save_member_badges(guild.id, {
+            change.member.id: get_state_after_change(change, ladder, role_ids)})
 
+
+    @timed('on_message')
     async def on_message(self, message: Message):
-        # Ignore messages from bots. Prevents infinite loops.
-        if message.author.bot:
+        await self.message_router.dispatch(message)
+
+
+    async def route_messages(self, guild: Guild):
+        """Register the message handlers of the guild's channels.
+
+        Channels and roles are given by name in the settings, so this has to
+        be done again if any of them are renamed.
+        """
+        status_channel = self.status_channel.get(guild.id)
+        if not status_channel:
+            # The startup of the guild failed or is not done.
             return
-        
-        await check_doorbell(message=message, doorbell_settings=self.settings['doorbell'],
-                       doorbell_responses=self.doorbell_responses)
 
+        # Remove the old routes of the guild.
+        for channel_id in [channel.id for channel in guild.channels]:
+            self.message_router.routes.pop(channel_id, None)
 
-    async def sync_commands(self):
-        """Sync commands with the guilds."""
-        for guild in self.guilds:
+        doorbell_settings = self.config.settings.doorbell
+        doorbell_channel = get_text_channel_by_name(
+            guild, doorbell_settings.channel)
+        if not doorbell_channel:
+            await log(status_channel, f'Warning: Doorbell channel {doorbell_settings.channel} not found.')
+            return
+
+        # Only allow some members to ring the doorbell if there is a doorbell
+        # role specified.
+        allowed_role_ids = None
+        allowed_user_role = doorbell_settings.allowed_user_role
+        if allowed_user_role:
+            role = get_role_by_name(guild, allowed_user_role)
+            if not role:
+                await log(status_channel, f'Warning: Doorbell role {allowed_user_role} not found. No one can use the doorbell.')
+            allowed_role_ids = frozenset({role.id} if role else ())
+
+        # The responses are looked up for every message, so that they can be
+        # reloaded without routing again.
+        self.message_router.add_route(
+            doorbell_channel.id,
+            lambda message: ring_doorbell(
+                message, self.config.responses, self.doorbell),
+            allowed_role_ids,
+            lambda message: refuse_doorbell(message, self.config.responses))
+
+
+    async def on_config_change(self, old_config: Config, new_config: Config,
+                               changed: set[str]):
+        """Rebuild what depends on the changed sections of the config."""
+        print(f"Reloaded the config, changed: {', '.join(sorted(changed))}.")
+        # Only the guilds that were started.
+        guilds = [guild for guild in self.guilds
+                  if guild.id in self.status_channel]
+
+        if (old_config.settings.debug.status_channel
+                != new_config.settings.debug.status_channel):
+            for guild in guilds:
+                try:
+                    self.status_channel[guild.id] = \
+                        self.find_status_channel(guild)
+                except RuntimeError as error:
+                    await log(self.status_channel[guild.id], f'Warning: {error} Keeping the old one.')
+
+        restart_needed = changed & RESTART_SECTIONS
+        if old_config.settings.doorbell.pin != new_config.settings.doorbell.pin:
+            restart_needed.add('doorbell.pin')
+        for guild in guilds:
             status_channel = self.status_channel[guild.id]
+            await log(status_channel, f"Reloaded the config, changed: {', '.join(sorted(changed))}.")
+            if restart_needed:
+                await log(status_channel, f"Warning: Changes to {', '.join(sorted(restart_needed))} are used after a restart.")
+
+        if 'doorbell' in changed:
+            self.doorbell.cooldown = max(new_config.settings.doorbell.cooldown,
+                                         self.doorbell.pulse_length)
+            for guild in guilds:
+                await self.route_messages(guild)
+
+        if 'seniority_badge' in changed:
+            for guild in guilds:
+                invalidate_badge_ladder(guild)
+                ladder = get_badge_ladder(guild, self.role_affixes)
+                for problem in validate_badge_ladder(ladder, self.role_affixes):
+                    await log(self.status_channel[guild.id], f'Warning: {problem}')
+                self.start_badge_recompute(guild)
+
+
+    async def on_config_error(self, error: Exception):
+        """Report a config that could not be reloaded."""
+        message = f'Warning: Keeping the old config. {error}'
+        if not isinstance(error, ConfigError):
+            # The new config might already be used by some listeners.
+            message = f'Warning: Reloading the config failed: {error!r}'
+        print(message)
+        for status_channel in self.status_channel.values():
+            await log(status_channel, message)
+
+
+    async def on_guild_role_create(self, role: Role):
+        get_guild_index(role.guild).add_role(role)
+        invalidate_badge_ladder(role.guild)
+
+
+    async def on_guild_role_update(self, role_before: Role, role_after: Role):
+        get_guild_index(role_after.guild).update_role(role_before, role_after)
+        # The name or position of a badge role might have changed.
+        invalidate_badge_ladder(role_after.guild)
+        if role_before.name != role_after.name:
+            await self.route_messages(role_after.guild)
+
+
+    async def on_guild_role_delete(self, role: Role):
+        get_guild_index(role.guild).remove_role(role)
+        invalidate_badge_ladder(role.guild)
+
+
+    async def on_guild_channel_create(self, channel: GuildChannel):
+        get_guild_index(channel.guild).add_channel(channel)
+
+
+    async def on_guild_channel_update(self, channel_before: GuildChannel,
+                                      channel_after: GuildChannel):
+        get_guild_index(channel_after.guild).update_channel(
+            channel_before, channel_after)
+        if channel_before.name != channel_after.name:
+            await self.route_messages(channel_after.guild)
+
+
+    async def on_guild_channel_delete(self, channel: GuildChannel):
+        get_guild_index(channel.guild).remove_channel(channel)
+
+
+    async def on_guild_remove(self, guild: Guild):
+        forget_guild(guild)
+
+
+    async def close(self):
+        # Send the last log messages while still connected.
+        await flush_logs()
+        if self.config_task:
+            self.config_task.cancel()
+        # Resumed from their checkpoints at the next start.
+        for task in self.badge_recomputes.values():
+            task.cancel()
+        await super().close()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+        self.store.close()
+        self.doorbell.close()
+        if self.trace_recorder:
+            self.trace_recorder.close()
+
+
+    def dispatch(self, event: str, /, *args, **kwargs):
+        if self.trace_recorder:
+            self.trace_recorder.record_event(event, args)
+        super().dispatch(event, *args, **kwargs)
+
+
+    def get_stats_text(self) -> str:
+        return '\n'.join((
+            metrics.summary(),
+            f'**Connection**: {self.connection_metrics}',
+            f'**Member updates**: {self.member_update_stats}',
+            f'**Role writes**: {role_writes.stats}',
+            f'**Doorbell**: {self.doorbell.pulses} pulses,'
+            f' {self.doorbell.coalesced} rings merged.'))
+
+
+    async def sync_guild_commands(self, guild: Guild):
+        """Sync commands with a guild, unless they are the same as when they
+        were last synced."""
+        status_channel = self.status_channel[guild.id]
+        self.tree.copy_global_to(guild=guild)
+        fingerprint = self.get_command_fingerprint(guild)
+        meta_key = f'command_sync_fingerprint:{guild.id}'
+        if self.store.get_meta(meta_key) == fingerprint:
+            await log(status_channel, 'Commands are already synced.')
+            return
+
+        await log(status_channel, 'Syncing commands...')
+        await self.tree.sync(guild=guild)
+        # Only stored once the sync succeeded.
+        self.store.set_meta(meta_key, fingerprint)
+        await log(status_channel, 'Done syncing commands.')
+
+
+    def get_command_fingerprint(self, guild: Guild) -> str:
+        """Hash the commands that would be synced with the guild."""
+        commands = [command.to_dict(self.tree)
+                    for command in self.tree.get_commands(guild=guild)]
+        return sha256(
+            json.dumps(commands, sort_keys=True).encode()).hexdigest()
+
 
-            await log(status_channel, 'Syncing commands...')
-            await self.tree.sync(guild=guild)
-            await log(status_channel, 'Done syncing commands.')
+class ShardedHouseRobot(HouseRobot, AutoShardedClient):
+    """HouseRobot that connects through several shards, for when the bot is
+    in many guilds."""
@@ -1,22 +1,178 @@
-from discord import Guild, Invite, Member
+import asyncio
+from collections.abc import Callable
+from dataclasses import dataclass
+from enum import Enum
+
+from discord import Guild, HTTPException, Invite, Member, Role, TextChannel
 
 from bot_logging import log
+from config import InviteRole
+from helpers import get_role_by_name
+from role_writes import role_writes
+
+
+class AttributionConfidence(Enum):
+    """How sure the tracker is about which invite a member used."""
+    # Exactly one invite was used, once for every member that joined.
+    CERTAIN = 'certain'
+    # Several invites could have been used, but they all lead to the same
+    # channel, the uses did not add up to the number of joins or the invite
+    # was deleted.
+    LIKELY = 'likely'
+    # Several invites to different channels could have been used.
+    AMBIGUOUS = 'ambiguous'
+    # No used invite was found.
+    UNKNOWN = 'unknown'
+
+
+@dataclass
+class InviteAttribution:
+    """The invite a member most likely joined through."""
+    member: Member
+    invite: Invite|None
+    confidence: AttributionConfidence
+
+
+def attribute_joins(members: list[Member], uses_before: dict[str, int],
+                    invites_after: list[Invite],
+                    deleted_invites: list[Invite] = ()
+                    ) -> list[InviteAttribution]:
+    """Match members that joined between two invite snapshots to the invites
+    whose uses went up.
+
+    Invites that were deleted in between could have been deleted because they
+    reached their maximum number of uses, so they are counted as used once.
+    """
+    used = []
+    for invite in invites_after:
+        delta = invite.uses - uses_before.get(invite.code, 0)
+        if delta > 0:
+            used.append((invite, delta))
+    for invite in deleted_invites:
+        if invite.max_uses and (invite.uses or 0) < invite.max_uses:
+            used.append((invite, 1))
+
+    def attribute_all(invite, confidence):
+        return [InviteAttribution(member, invite, confidence)
+                for member in members]
+
+    if not used:
+        return attribute_all(None, AttributionConfidence.UNKNOWN)
+
+    total_uses = sum(delta for _, delta in used)
+    if len(used) == 1:
+        invite, _ = used[0]
+        # A deleted invite might have been deleted by hand instead of used.
+        was_deleted = any(deleted.code == invite.code
+                          for deleted in deleted_invites)
+        confidence = (AttributionConfidence.CERTAIN
+                      if total_uses == len(members) and not was_deleted
+                      else AttributionConfidence.LIKELY)
+        return attribute_all(invite, confidence)
+
+    # Which of several invites a member used only matters for the channel it
+    # leads to.
+    channel_ids = {invite.channel.id for invite, _ in used if invite.channel}
+    if len(channel_ids) == 1:
+        return attribute_all(used[0][0], AttributionConfidence.LIKELY)
+    return attribute_all(None, AttributionConfidence.AMBIGUOUS)
+
+
+class InviteTracker:
+    """Keeps track of the invite uses of a guild to tell which invite new
+    members used.
+
+    Created and deleted invites are tracked from events. Members joining within
+    `join_window` seconds of each other are attributed together using a single
+    fetch of the invites.
+    """
+
+    def __init__(self, guild: Guild, join_window: float = 1.0,
+                 on_fetch: Callable[[Guild, list[Invite]], None]|None = None):
+        self.guild = guild
+        self.join_window = join_window
+        # Called with every list of invites fetched, e.g. to record them.
+        self.on_fetch = on_fetch
+        self.uses: dict[str, int] = {}
+        self.max_uses: dict[str, int] = {}
+        self.deleted: list[Invite] = []
+        self.pending: list[tuple[Member, asyncio.Future]] = []
+        self._resolve_task: asyncio.Task|None = None
+
+    def _store_invites(self, invites: list[Invite]):
+        if self.on_fetch is not None:
+            self.on_fetch(self.guild, invites)
+        self.uses = {invite.code: invite.uses for invite in invites}
+        self.max_uses = {invite.code: invite.max_uses or 0
+                         for invite in invites}
+        self.deleted.clear()
+
+    async def snapshot(self):
+        """Store the current uses of every invite."""
+        self._store_invites(await self.guild.invites())
+
+    def invite_created(self, invite: Invite):
+        self.uses[invite.code] = invite.uses or 0
+        self.max_uses[invite.code] = invite.max_uses or 0
+
+    def invite_deleted(self, invite: Invite):
+        # The invite of the delete event only has its code and channel, so
+        # fill in what was known about it.
+        invite.uses = self.uses.pop(invite.code, 0)
+        invite.max_uses = self.max_uses.pop(invite.code, 0)
+        self.deleted.append(invite)
+
+    async def attribute(self, member: Member) -> InviteAttribution:
+        """Find out which invite the member joined through."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((member, future))
+        if self._resolve_task is None or self._resolve_task.done():
+            self._resolve_task = asyncio.create_task(self._resolve())
+        return await future
+
+    async def _resolve(self):
+        while self.pending:
+            # Let other members that join at the same time be part of the
+            # same diff.
+            await asyncio.sleep(self.join_window)
+            pending, self.pending = self.pending, []
+            members = [member for member, _ in pending]
+            try:
+                invites = await self.guild.invites()
+            except HTTPException as error:
+                print(f'Could not fetch the invites of {self.guild}: {error}')
+                attributions = [
+                    InviteAttribution(
+                        member, None, AttributionConfidence.UNKNOWN)
+                    for member in members]
+            else:
+                attributions = attribute_joins(
+                    members, self.uses, invites, self.deleted)
+                self._store_invites(invites)
+            for (_, future), attribution in zip(pending, attributions):
+                future.set_result(attribution)
 
 
-async def get_invite_uses(guild: Guild):
-    """Get the number of uses for each invite in the guild."""
-    invite_uses = {}
-    for invite in await guild.invites():
-        invite_uses[invite.code] = invite.uses
-    return invite_uses
+async def get_invite_roles(guild: Guild, invite: Invite,
+                           invite_roles: tuple[InviteRole, ...],
+                           status_channel: TextChannel) -> list[Role]:
+    """Get the roles of the channel the invite leads to."""
+    channel_name = getattr(invite.channel, 'name', None)
+    roles = []
+    for invite_role in invite_roles:
+        if invite_role.channel != channel_name:
+            continue
+        role = get_role_by_name(guild, invite_role.role)
+        if not role:
+            await log(status_channel, f'Warning: Invite role {invite_role.role} not found.')
+            continue
+        roles.append(role)
+    return roles
 
 
-async def apply_invite_role(member: Member, invite: Invite,
-                            invite_settings: dict,
-                            status_channel: str):
-    for invite_setting in invite_settings:
-        channel = invite_setting['channel']
-        role = invite_setting['role']
-        if invite.channel.name == channel:
-            await member.add_roles(role)
-            await log(status_channel, f'{member.name} assigned the role "{invite.channel.name}".')
+async def apply_invite_roles(member: Member, roles: list[Role],
+                             status_channel: TextChannel):
+    """Give the member the roles of the channel they were invited to."""
+    for role in roles:
+        await role_writes.add_roles(member, role, reason='Invite')
+        await log(status_channel, f'{member.name} assigned the role "{role.name}".')
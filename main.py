@@ -1,10 +1,16 @@
-import json
+# Imported first, so that the imports of everything else are timed.
+from startup_profile import startup_profiler
+import_phase = startup_profiler.start('import')
 
-from aiohttp import ClientConnectorError
 import asyncio
-from discord import Intents, utils
+from discord import Intents, MemberCacheFlags, utils
 
-from house_robot import HouseRobot
+from bot_logging import setup_file_logging
+from config import ConfigError, ConfigWatcher
+from house_robot import HouseRobot, ShardedHouseRobot
+from supervisor import Supervisor
+
+startup_profiler.end(import_phase)
 
 # Choose which events to listen for. Some need to be enabled in the developer
 # portal as well.
@@ -18,32 +24,33 @@ utils.setup_logging(root=False)
 
 
 async def main():
-    connection_retry_delay = 10 # seconds
-
-    # Load data from files.
-    with open('settings.json', encoding='utf-8') as json_file:
-        settings = json.load(json_file)
-    with open('responses.json', encoding='utf-8') as json_file:
-        doorbell_responses = json.load(json_file)
-
-    # Keep the client connected. Only exits if the client stops without error.
-    while True:
-        try:
-            # XXX: Recreate client each try. Could probably be reused instead.
-            client = HouseRobot(intents=intents, settings=settings,
-                                doorbell_responses=doorbell_responses)
-            # Short for login() + connect().
-            await client.start(settings['discord_token'])
-            # Exit if client stopped without error.
-            break
-        # XXX: This is an asyncio exception. Maybe Discord.py exceptions should
-        # be caught instead.
-        except ClientConnectorError:
-            print('Connection failed.')
-            # XXX: Close the client before recreating it.
-            await client.close()
-            print(f'Retrying in { connection_retry_delay } seconds...')
-            await asyncio.sleep(connection_retry_delay)
+    # Load and check the configuration files. They are reloaded while running
+    # if they change.
+    try:
+        with startup_profiler.phase('config load'):
+            config_watcher = ConfigWatcher()
+    except ConfigError as error:
+        raise SystemExit(error)
+    settings = config_watcher.config.settings
+
+    # Keep a local copy of the status messages.
+    if settings.debug.log_file:
+        setup_file_logging(settings.debug.log_file)
+
+    client_class = ShardedHouseRobot if settings.sharded else HouseRobot
+    if settings.member_cache:
+        member_cache_flags = MemberCacheFlags.from_intents(intents)
+    else:
+        # Only the seniority index is kept, which is much smaller.
+        member_cache_flags = MemberCacheFlags.none()
+    client = client_class(config_watcher, intents=intents,
+                          member_cache_flags=member_cache_flags,
+                          chunk_guilds_at_startup=settings.member_cache)
+    supervisor = Supervisor(client, settings.discord_token,
+                            client.connection_metrics)
+    # Keep the client connected. Only exits if the client is closed.
+    async with client:
+        await supervisor.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from time import monotonic
+
+from discord import Member
+from discord.state import ConnectionState
+
+
+class PendingRoleMutations:
+    """Roles the bot expects members to have after changing them itself.
+
+    Discord sends a member update event for every change the bot makes. Those
+    events can be recognised by the roles matching an expected set, and
+    ignored.
+    """
+
+    def __init__(self, timeout: float = 60.0):
+        # Expectations older than this many seconds are dropped, in case the
+        # change failed or the event never arrived.
+        self.timeout = timeout
+        # Keyed by guild and member id, since a user can be a member of
+        # several guilds.
+        self.expected: dict[tuple[int, int],
+                            list[tuple[frozenset[int], float]]] = {}
+
+    def expect(self, member: Member, role_ids: frozenset[int]):
+        key = (member.guild.id, member.id)
+        self.expected.setdefault(key, []).append((role_ids, monotonic()))
+
+    def consume(self, member: Member, role_ids: frozenset[int]) -> bool:
+        """Check if the roles are the result of a change made by the bot, and
+        if so forget the expectation."""
+        key = (member.guild.id, member.id)
+        expectations = self.expected.get(key)
+        if not expectations:
+            return False
+        now = monotonic()
+        expectations[:] = [
+            (expected_role_ids, expected_at)
+            for expected_role_ids, expected_at in expectations
+            if now - expected_at < self.timeout]
+        for i, (expected_role_ids, _) in enumerate(expectations):
+            if expected_role_ids == role_ids:
+                del expectations[i]
+                break
+        else:
+            return False
+        if not expectations:
+            del self.expected[key]
+        return True
+
+
+# Shared by everything that changes the roles of members.
+pending_role_mutations = PendingRoleMutations()
+
+
+@dataclass
+class MemberUpdateStats:
+    handled: int = 0
+    # Skipped since no roles changed, e.g. only the nickname.
+    skipped_no_role_change: int = 0
+    # Skipped since neither year nor badge roles changed, e.g. team roles.
+    skipped_other_roles: int = 0
+    # Skipped since the bot caused the change itself.
+    skipped_echo: int = 0
+
+    @property
+    def skipped(self) -> int:
+        return (self.skipped_no_role_change + self.skipped_other_roles
+                + self.skipped_echo)
+
+    def __str__(self):
+        return (f'{self.handled} member updates handled, {self.skipped} skipped'
+                f' ({self.skipped_no_role_change} without role changes,'
+                f' {self.skipped_other_roles} with other roles,'
+                f' {self.skipped_echo} caused by the bot).')
+
+
+def should_adjust_badge(member_before: Member, member_after: Member,
+                        badge_related_role_ids: frozenset[int],
+                        stats: MemberUpdateStats,
+                        pending: PendingRoleMutations = pending_role_mutations
+                        ) -> bool:
+    """Check if a member update could mean the seniority badge is wrong.
+
+    Only changes to the year and badge roles in `badge_related_role_ids` can
+    do that.
+    """
+    role_ids_before = frozenset(role.id for role in member_before.roles)
+    role_ids_after = frozenset(role.id for role in member_after.roles)
+    if role_ids_before == role_ids_after:
+        stats.skipped_no_role_change += 1
+        return False
+
+    if pending.consume(member_after, role_ids_after):
+        stats.skipped_echo += 1
+        return False
+
+    # A badge removed or added by someone else is handled as well, to put
+    # the correct badge back.
+    if (role_ids_before & badge_related_role_ids
+            == role_ids_after & badge_related_role_ids):
+        stats.skipped_other_roles += 1
+        return False
+
+    stats.handled += 1
+    return True
+
+
+def dispatch_uncached_member_updates(connection: ConnectionState):
+    """Make discord.py dispatch `uncached_member_update` events.
+
+    discord.py drops the updates of members that are not in its member cache,
+    which are all of them when the cache is disabled. The event is called with
+    the guild, the member id and the ids of the member's roles.
+    """
+    parsers = connection.parsers
+    parse_member_update = parsers['GUILD_MEMBER_UPDATE']
+
+    def parse(data):
+        guild = connection._get_guild(int(data['guild_id']))
+        member_id = int(data['user']['id'])
+        if guild is not None and guild.get_member(member_id) is None:
+            connection.dispatch(
+                'uncached_member_update', guild, member_id,
+                frozenset(int(role_id) for role_id in data['roles']))
+        parse_member_update(data)
+
+    # The gateway looks the parsers up in the same dict.
+    parsers['GUILD_MEMBER_UPDATE'] = parse
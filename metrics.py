@@ -0,0 +1,212 @@
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Awaitable, Callable
+import functools
+import logging
+from time import monotonic
+
+import discord
+
+
+class Histogram:
+    """Counts of observed durations in fixed buckets, like Prometheus does."""
+
+    # Upper bounds of the buckets, in seconds.
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+              30.0, 60.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it is in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.BOUNDS[-1]
+
+    def __str__(self):
+        mean = self.sum / self.count if self.count else 0.0
+        return (f'{self.count} calls, mean {mean * 1000:.0f} ms,'
+                f' p50 ≤ {self.quantile(0.5) * 1000:.0f} ms,'
+                f' p99 ≤ {self.quantile(0.99) * 1000:.0f} ms')
+
+
+class Metrics:
+    """Everything measured while the bot runs, kept in memory."""
+
+    def __init__(self):
+        self.handler_latency: dict[str, Histogram] = {}
+        # Keyed by (method, route), where the route has placeholders for ids.
+        self.api_calls: Counter[tuple[str, str]] = Counter()
+        self.api_errors: Counter[int] = Counter()
+        self.api_latency = Histogram()
+        self.rate_limit_hits = 0
+        # The hits that held up every request, not just those of one route.
+        self.global_rate_limit_hits = 0
+        self.rate_limit_wait = 0.0 # seconds
+
+    def observe_handler(self, name: str, duration: float):
+        histogram = self.handler_latency.get(name)
+        if histogram is None:
+            histogram = self.handler_latency[name] = Histogram()
+        histogram.observe(duration)
+
+    def summary(self, max_routes: int = 10) -> str:
+        """Describe the metrics for humans."""
+        lines = ['**Handlers**']
+        lines += [f'{name}: {histogram}'
+                  for name, histogram in sorted(self.handler_latency.items())]
+        lines.append(f'**API requests** ({sum(self.api_calls.values())},'
+                     f' {self.api_latency})')
+        lines += [f'{method} {route}: {count}'
+                  for (method, route), count
+                  in self.api_calls.most_common(max_routes)]
+        if self.api_errors:
+            lines.append('Errors: ' + ', '.join(
+                f'{status}: {count}'
+                for status, count in sorted(self.api_errors.items())))
+        lines.append(f'**Rate limits**: {self.rate_limit_hits} hits'
+                     f' ({self.global_rate_limit_hits} global),'
+                     f' {self.rate_limit_wait:.1f} s waited')
+        return '\n'.join(lines)
+
+    def to_prometheus(self) -> str:
+        """Format the metrics in the Prometheus text format."""
+        lines = [
+            '# TYPE house_robot_handler_seconds histogram']
+        for name, histogram in sorted(self.handler_latency.items()):
+            lines += _format_histogram(
+                'house_robot_handler_seconds', f'handler="{name}"', histogram)
+        lines.append('# TYPE house_robot_api_requests_total counter')
+        for (method, route), count in sorted(self.api_calls.items()):
+            lines.append(
+                f'house_robot_api_requests_total{{method="{method}",'
+                f'route="{route}"}} {count}')
+        lines.append('# TYPE house_robot_api_errors_total counter')
+        for status, count in sorted(self.api_errors.items()):
+            lines.append(
+                f'house_robot_api_errors_total{{status="{status}"}} {count}')
+        lines.append('# TYPE house_robot_api_request_seconds histogram')
+        lines += _format_histogram(
+            'house_robot_api_request_seconds', '', self.api_latency)
+        lines += [
+            '# TYPE house_robot_rate_limit_hits_total counter',
+            f'house_robot_rate_limit_hits_total {self.rate_limit_hits}',
+            '# TYPE house_robot_global_rate_limit_hits_total counter',
+            'house_robot_global_rate_limit_hits_total'
+            f' {self.global_rate_limit_hits}',
+            '# TYPE house_robot_rate_limit_wait_seconds_total counter',
+            f'house_robot_rate_limit_wait_seconds_total {self.rate_limit_wait}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def _format_histogram(name: str, labels: str, histogram: Histogram
+                      ) -> list[str]:
+    separator = ',' if labels else ''
+    lines = []
+    total = 0
+    for bound, count in zip(histogram.BOUNDS, histogram.counts):
+        total += count
+        le = '+Inf' if bound == float('inf') else bound
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {total}')
+    braces = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{braces} {histogram.sum}')
+    lines.append(f'{name}_count{braces} {histogram.count}')
+    return lines
+
+
+# Shared by everything that is measured.
+metrics = Metrics()
+
+
+def timed(name: str):
+    """Measure how long each call of a coroutine function takes."""
+    def decorator(function: Callable[..., Awaitable]):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                metrics.observe_handler(name, monotonic() - start)
+        return wrapper
+    return decorator
+
+
+def instrument_http(http: discord.http.HTTPClient):
+    """Count and time every request discord.py makes to Discord."""
+    request = http.request
+
+    async def instrumented_request(route: discord.http.Route, **kwargs):
+        start = monotonic()
+        try:
+            return await request(route, **kwargs)
+        except discord.RateLimited:
+            # Raised instead of waiting when the wait would be too long, so
+            # discord.py doesn't log it as a retry.
+            metrics.rate_limit_hits += 1
+            raise
+        except discord.HTTPException as error:
+            metrics.api_errors[error.status] += 1
+            raise
+        finally:
+            metrics.api_calls[route.method, route.path] += 1
+            metrics.api_latency.observe(monotonic() - start)
+
+    http.request = instrumented_request
+
+
+class _RateLimitHandler(logging.Handler):
+    """Picks up the rate limits discord.py waits out from its log."""
+
+    # The message discord.py logs when retrying after a 429 response.
+    RETRY_MESSAGE = ('We are being rate limited. %s %s responded with 429.'
+                     ' Retrying in %.2f seconds.')
+    # Logged as well when the 429 is for the global rate limit.
+    GLOBAL_MESSAGE = 'Global rate limit has been hit. Retrying in %.2f seconds.'
+
+    def emit(self, record: logging.LogRecord):
+        if record.msg == self.RETRY_MESSAGE and len(record.args) == 3:
+            metrics.rate_limit_hits += 1
+            metrics.rate_limit_wait += record.args[2]
+        elif record.msg == self.GLOBAL_MESSAGE:
+            # The wait was counted with the retry message logged before it.
+            metrics.global_rate_limit_hits += 1
+
+
+def track_rate_limits():
+    logger = logging.getLogger('discord.http')
+    logger.addHandler(_RateLimitHandler(logging.WARNING))
+    if logger.getEffectiveLevel() > logging.WARNING:
+        logger.setLevel(logging.WARNING)
+
+
+async def start_metrics_server(host: str, port: int):
+    """Serve the metrics in the Prometheus text format on /metrics."""
+    # Only needed when the endpoint is enabled.
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.to_prometheus(),
+                            content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
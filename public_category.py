@@ -1,6 +1,11 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
 import discord
 
 from bot_logging import log
+from config import ChannelPermissions, ChannelSetup
 import helpers
 
 
@@ -85,7 +90,7 @@ async def create_channel_overwrites(
     category_overwrites: dict[
         discord.Role|discord.Member,
         discord.PermissionOverwrite],
-    channel_permissions_json: list[dict],
+    channel_permissions: tuple[ChannelPermissions, ...],
     year_specific_role: discord.Role,
     year_specific_role_prefix: str
 ) -> dict[discord.Role|discord.Member, discord.PermissionOverwrite]|None:
@@ -102,7 +107,7 @@ async def create_channel_overwrites(
     """
 
     # Return an empty dict if there are no permissions to overwrite.
-    if not channel_permissions_json:
+    if not channel_permissions:
         return {}
 
     # Perform deep copy of inherited permissions to be able to overwrite them.
@@ -111,8 +116,8 @@ async def create_channel_overwrites(
         for role, overwrite in category_overwrites.items()}
 
     # Add or remove permissions.
-    for channel_permission_json in channel_permissions_json:
-        role_name = channel_permission_json['role']
+    for channel_permission in channel_permissions:
+        role_name = channel_permission.role
         # Get role whose permissions should be overwritten. Parse name for
         # special cases first.
         if role_name == '@everyone':
@@ -135,10 +140,10 @@ async def create_channel_overwrites(
             channel_overwrites[role] = discord.PermissionOverwrite()
         add_kwargs = {
             permission: True
-            for permission in channel_permission_json['add']}
+            for permission in channel_permission.add}
         remove_kwargs = {
             permission: False
-            for permission in channel_permission_json['remove']}
+            for permission in channel_permission.remove}
         channel_overwrites[role].update(**add_kwargs, **remove_kwargs)
     return channel_overwrites
 
@@ -166,3 +171,253 @@ async def create_or_update_text_channel(
             overwrites=overwrites,
             category=category)
     return channel
+
+
+def create_category_overwrites(
+    guild: discord.Guild,
+    robot_group_role: discord.Role,
+    year_specific_role: discord.abc.Snowflake
+) -> dict[discord.abc.Snowflake, discord.PermissionOverwrite]:
+    """Create overwrites for the category that can be synched with its
+    channels."""
+    return {
+        robot_group_role: discord.PermissionOverwrite(
+            view_channel=True, connect=True, send_messages=True, speak=True),
+        year_specific_role: discord.PermissionOverwrite(
+            view_channel=True, connect=True),
+        guild.default_role: discord.PermissionOverwrite(
+            view_channel=False, connect=False, send_messages=False, speak=False)
+    }
+
+
+def same_overwrites(
+    overwrites: dict[discord.abc.Snowflake, discord.PermissionOverwrite],
+    other_overwrites: dict[discord.abc.Snowflake, discord.PermissionOverwrite]
+) -> bool:
+    def pairs(overwrites):
+        return {target.id: overwrite.pair()
+                for target, overwrite in overwrites.items()
+                if not overwrite.is_empty()}
+    return pairs(overwrites) == pairs(other_overwrites)
+
+
+# Stands in for the year-specific role when planning before it is created.
+_MISSING_ROLE = discord.Object(id=0)
+
+
+@dataclass
+class _SetupState:
+    """The objects the operations of a setup plan work on. Operations that
+    create them fill them in for the operations that follow."""
+    year_role: discord.Role|None
+    category: discord.CategoryChannel|None
+
+
+@dataclass
+class SetupOperation:
+    """A change needed to set up a competition year."""
+    description: str
+    run: Callable[[], Awaitable[None]]
+    # Phases are applied in order. Operations that don't depend on each other
+    # within a phase can be applied concurrently.
+    phase: int
+    concurrent: bool = False
+
+
+@dataclass
+class SetupPlan:
+    """The operations needed to make the guild match the setup of a year."""
+    year: int
+    operations: list[SetupOperation] = field(default_factory=list)
+
+    def __str__(self):
+        if not self.operations:
+            return f'Nothing to do for year {self.year}.'
+        return '\n'.join(
+            f'{i}. {operation.description}'
+            for i, operation in enumerate(self.operations, start=1))
+
+
+async def plan_year_setup(
+    guild: discord.Guild,
+    status_channel: discord.TextChannel,
+    year: int,
+    robot_group_role: discord.Role,
+    channels: tuple[ChannelSetup, ...],
+    year_role_prefix: str,
+    year_category_prefix: str
+) -> SetupPlan|None:
+    """Compare the setup of a year with the guild and plan the operations
+    needed to make them match.
+
+    Nothing is changed in the guild. Return None if the setup can't be
+    planned.
+    """
+    plan = SetupPlan(year)
+    year_role_name = f'{year_role_prefix} {year}'
+    year_category_name = f'{year_category_prefix} {year}'
+    state = _SetupState(
+        helpers.get_role_by_name(guild, year_role_name),
+        helpers.get_category_by_name(guild, year_category_name))
+
+    def get_category_overwrites():
+        return create_category_overwrites(
+            guild, robot_group_role, state.year_role or _MISSING_ROLE)
+
+    # Roles.
+    if not state.year_role:
+        async def create_role():
+            state.year_role = await guild.create_role(name=year_role_name)
+            await log(status_channel, f'Role {year_role_name} created.')
+        plan.operations.append(SetupOperation(
+            f'Create role {year_role_name}.', create_role, phase=0))
+
+    previous_year_role = helpers.get_first_role_by_prefix(
+        guild, year_role_prefix, state.year_role)
+    if previous_year_role:
+        roles = guild.roles
+        is_placed = (
+            state.year_role in roles
+            and roles.index(state.year_role) + 1
+                == roles.index(previous_year_role))
+    if previous_year_role and not is_placed:
+        async def move_role():
+            # NOTE: Role.move() and CategoryChannel.move() use their
+            # parameters in opposite ways. Read the docs carafully about how
+            # the parameters "above" and "before" are treated.
+            await state.year_role.move(above=previous_year_role)
+            await log(status_channel,
+                f'Moved role {year_role_name} below the other year roles.')
+        plan.operations.append(SetupOperation(
+            f'Move role {year_role_name} below {previous_year_role.name}.',
+            move_role, phase=1))
+
+    # Category.
+    if not state.category:
+        async def create_category():
+            state.category = await guild.create_category(
+                year_category_name, overwrites=get_category_overwrites())
+            await log(status_channel,
+                f'Category {year_category_name} created.')
+        plan.operations.append(SetupOperation(
+            f'Create category {year_category_name}.', create_category,
+            phase=2))
+
+    previous_year_category = helpers.get_first_category_by_prefix(
+        guild, year_category_prefix, state.category)
+    if previous_year_category:
+        categories = guild.categories
+        is_placed = (
+            state.category
+            and state.category in categories
+            and categories.index(state.category) + 1 < len(categories)
+            and categories[categories.index(state.category) + 1]
+                == previous_year_category)
+        if not is_placed:
+            async def move_category():
+                await state.category.move(before=previous_year_category)
+                await log(status_channel,
+                    f'Moved category {year_category_name} above the other year categories.')
+            plan.operations.append(SetupOperation(
+                f'Move category {year_category_name} above {previous_year_category.name}.',
+                move_category, phase=3))
+
+    # Channels.
+    existing_channels = (
+        state.category.text_channels if state.category else [])
+    desired_names = []
+    for channel_setup in channels:
+        name = channel_setup.name
+        topic = channel_setup.topic
+        permissions = channel_setup.permissions
+        desired_names.append(name)
+
+        category_overwrites = get_category_overwrites()
+        overwrites = await create_channel_overwrites(
+            guild, status_channel, category_overwrites, permissions,
+            state.year_role or _MISSING_ROLE, year_role_prefix)
+        # Abort if an error occured.
+        if overwrites is None:
+            return None
+
+        channel = next(
+            (channel for channel in existing_channels if channel.name == name),
+            None)
+        if not channel:
+            async def create_channel(name=name, topic=topic,
+                                     permissions=permissions):
+                # Overwrites have to be created again if the year role was
+                # created by this plan. Written like the updates, so that the
+                # next plan finds the channel up to date.
+                category_overwrites = get_category_overwrites()
+                overwrites = await create_channel_overwrites(
+                    guild, status_channel, category_overwrites, permissions,
+                    state.year_role, year_role_prefix)
+                await create_or_update_text_channel(
+                    state.category, status_channel, name, topic,
+                    overwrites or category_overwrites)
+            # Created one at a time to get them in the right order.
+            plan.operations.append(SetupOperation(
+                f'Create channel {name}.', create_channel, phase=4))
+            continue
+
+        # Channels without overwrites inherit those of the category.
+        effective_overwrites = overwrites or category_overwrites
+        if (channel.topic or '') != topic or not same_overwrites(
+                channel.overwrites, effective_overwrites):
+            async def update_channel(name=name, topic=topic,
+                                     permissions=permissions):
+                # Written the same way they were compared, so that channels
+                # without overwrites of their own get those of the category
+                # instead of none at all.
+                category_overwrites = get_category_overwrites()
+                overwrites = await create_channel_overwrites(
+                    guild, status_channel, category_overwrites, permissions,
+                    state.year_role, year_role_prefix)
+                await create_or_update_text_channel(
+                    state.category, status_channel, name, topic,
+                    overwrites or category_overwrites)
+            plan.operations.append(SetupOperation(
+                f'Update channel {name}.', update_channel, phase=4,
+                concurrent=True))
+
+    # New channels end up last, so check if the final order is as desired.
+    final_names = [channel.name for channel in existing_channels
+                   if channel.name in desired_names]
+    final_names += [name for name in desired_names if name not in final_names]
+    if final_names != desired_names:
+        async def order_channels():
+            channels_by_name = {channel.name: channel
+                                for channel in state.category.text_channels}
+            ordered = [channels_by_name[name] for name in desired_names
+                       if name in channels_by_name]
+            for previous, channel in zip(ordered, ordered[1:]):
+                channels = state.category.text_channels
+                if channels.index(channel) != channels.index(previous) + 1:
+                    await channel.move(after=previous)
+            await log(status_channel,
+                f'Ordered the channels in {state.category.name}.')
+        plan.operations.append(SetupOperation(
+            f'Order the channels in {year_category_name}.', order_channels,
+            phase=5))
+
+    return plan
+
+
+async def apply_setup_plan(plan: SetupPlan, max_concurrency: int = 4):
+    """Apply the operations of a plan, phase by phase."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(operation: SetupOperation):
+        async with semaphore:
+            await operation.run()
+
+    phases = sorted({operation.phase for operation in plan.operations})
+    for phase in phases:
+        operations = [operation for operation in plan.operations
+                      if operation.phase == phase]
+        for operation in operations:
+            if not operation.concurrent:
+                await operation.run()
+        await asyncio.gather(*(run(operation) for operation in operations
+                               if operation.concurrent))
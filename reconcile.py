@@ -0,0 +1,246 @@
+import asyncio
+from dataclasses import dataclass
+from time import monotonic
+
+import discord
+
+from seniority_badge import BadgeChange, BadgeLadder, RoleAffixes, \
+    apply_badge_change, compute_badge_change, get_badge_ladder
+from state_store import MemberBadgeState, StateStore
+
+
+@dataclass
+class ReconcileReport:
+    """Summary of a badge reconciliation of a guild."""
+    scanned: int = 0
+    # Members whose roles did not change since the last reconcile.
+    unchanged_since_last_run: int = 0
+    changed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    elapsed: float = 0.0 # seconds
+
+    def __str__(self):
+        return (f'{self.scanned} members scanned'
+                f' ({self.unchanged_since_last_run} unchanged since last run),'
+                f' {self.changed} changed,'
+                f' {self.skipped} skipped, {self.failed} failed'
+                f' in {self.elapsed:.2f} s.')
+
+
+def get_member_badge_state(role_ids: set[int], ladder: BadgeLadder
+                           ) -> MemberBadgeState:
+    return MemberBadgeState(
+        frozenset(role_ids & ladder.year_role_ids),
+        frozenset(role_ids & ladder.any_badge_role_ids))
+
+
+class _BadgeDiff:
+    """The badge changes of the members checked so far."""
+
+    def __init__(self, role_affixes: RoleAffixes, ladder: BadgeLadder,
+                 known_states: dict[int, MemberBadgeState]|None):
+        self.role_affixes = role_affixes
+        self.ladder = ladder
+        self.known_states = known_states or {}
+        self.scanned = 0
+        self.changes: list[BadgeChange] = []
+        self.correct_states: dict[int, MemberBadgeState] = {}
+
+    def check(self, member: discord.Member):
+        """Check the badge of a member."""
+        self.scanned += 1
+        role_ids = {role.id for role in member.roles}
+        state = get_member_badge_state(role_ids, self.ladder)
+        if self.known_states.get(member.id) == state:
+            return
+        change = compute_badge_change(
+            member, self.role_affixes, self.ladder, role_ids)
+        if change:
+            self.changes.append(change)
+        else:
+            self.correct_states[member.id] = state
+
+
+def compute_badge_diff(guild: discord.Guild, role_affixes: RoleAffixes,
+                       known_states: dict[int, MemberBadgeState]|None = None
+                       ) -> tuple[list[BadgeChange], dict[int, MemberBadgeState]]:
+    """Compute the badge changes of every member in the guild.
+
+    Everything is computed from the cached guild, so no requests are made to
+    Discord. Members whose year and badge roles are the same as in
+    `known_states` are already correct and are skipped.
+
+    Return the changes, and the states of the members that were checked and
+    found correct.
+    """
+    diff = _BadgeDiff(role_affixes, get_badge_ladder(guild, role_affixes),
+                      known_states)
+    for member in guild.members:
+        diff.check(member)
+    return diff.changes, diff.correct_states
+
+
+async def fetch_badge_diff(guild: discord.Guild, role_affixes: RoleAffixes,
+                           known_states: dict[int, MemberBadgeState]|None = None
+                           ) -> tuple[int, list[BadgeChange],
+                                      dict[int, MemberBadgeState]]:
+    """Like compute_badge_diff, but for a guild without a member cache.
+
+    The members are fetched from Discord in chunks of 1000, and only those
+    that need changes are kept. Return the number of members as well.
+    """
+    diff = _BadgeDiff(role_affixes, get_badge_ladder(guild, role_affixes),
+                      known_states)
+    async for member in guild.fetch_members(limit=None):
+        diff.check(member)
+    return diff.scanned, diff.changes, diff.correct_states
+
+
+def get_state_after_change(change: BadgeChange, ladder: BadgeLadder,
+                           role_ids: set[int]|None = None
+                           ) -> MemberBadgeState:
+    """Get the badge state of the member once the change is written.
+
+    `role_ids` are the roles the change was decided from, by default the
+    roles of the member.
+    """
+    # The cached member is only updated once Discord sends the update event.
+    if role_ids is None:
+        role_ids = {role.id for role in change.member.roles}
+    state = get_member_badge_state(role_ids, ladder)
+    badge_role_ids = state.badge_role_ids - {
+        role.id for role in change.roles_to_remove}
+    if change.role_to_add:
+        badge_role_ids |= {change.role_to_add.id}
+    return MemberBadgeState(state.year_role_ids, badge_role_ids)
+
+
+def get_ladder_key(ladder: BadgeLadder) -> str:
+    """Identify the badge roles of a ladder, in order."""
+    return ','.join(str(i) for i in ladder.badge_role_ids[1:])
+
+
+def load_badge_states(store: StateStore, guild_id: int, ladder: BadgeLadder
+                      ) -> dict[int, MemberBadgeState]:
+    """Load the stored badge states of the guild's members.
+
+    The stored states only say the badges were correct for the badge roles at
+    the time, so they are dropped if the ladder changed.
+    """
+    ladder_key = get_ladder_key(ladder)
+    meta_key = f'badge_ladder:{guild_id}'
+    if store.get_meta(meta_key) == ladder_key:
+        return store.load_member_badges(guild_id)
+    store.clear_member_badges(guild_id)
+    store.set_meta(meta_key, ladder_key)
+    return {}
+
+
+class RateLimitGate:
+    """Lets every worker wait when one of them gets rate limited."""
+
+    def __init__(self):
+        self.resume_at = 0.0
+
+    async def wait(self):
+        while (delay := self.resume_at - monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, retry_after: float):
+        self.resume_at = max(self.resume_at, monotonic() + retry_after)
+
+
+async def apply_badge_changes(changes: list[BadgeChange],
+                              status_channel: discord.TextChannel,
+                              max_workers: int = 4,
+                              max_attempts: int = 3
+                              ) -> list[BadgeChange]:
+    """Apply badge changes using a bounded pool of workers.
+
+    Return the changes that could not be applied.
+    """
+    queue = asyncio.Queue()
+    for change in changes:
+        queue.put_nowait(change)
+    gate = RateLimitGate()
+    failed = []
+
+    async def worker():
+        while True:
+            try:
+                change = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            for attempt in range(1, max_attempts + 1):
+                await gate.wait()
+                try:
+                    # The change has all the roles of the member to write.
+                    await apply_badge_change(change, status_channel, window=0)
+                    break
+                except discord.RateLimited as error:
+                    gate.pause(error.retry_after)
+                except discord.HTTPException as error:
+                    # discord.py normally waits out rate limits by itself, but
+                    # a 429 can still get through when the limit is shared.
+                    if error.status == 429 and attempt < max_attempts:
+                        gate.pause(1.0)
+                        continue
+                    print(f'Could not adjust roles of {change.member.name}: {error}')
+                    failed.append(change)
+                    break
+            else:
+                print(f'Gave up adjusting roles of {change.member.name}.')
+                failed.append(change)
+
+    await asyncio.gather(*(worker() for _ in range(max_workers)))
+    return failed
+
+
+async def reconcile_badges(guild: discord.Guild, role_affixes: RoleAffixes,
+                           status_channel: discord.TextChannel,
+                           max_workers: int = 4,
+                           store: StateStore|None = None,
+                           fetch_members: bool = False) -> ReconcileReport:
+    """Give every member of the guild the correct seniority badge.
+
+    The whole diff is computed before any request is made, so only the members
+    that need new roles cost any requests. With a store, only the members whose
+    roles changed since the last reconcile are checked.
+
+    Without a member cache, set `fetch_members` to get the members from
+    Discord instead.
+    """
+    start = monotonic()
+    report = ReconcileReport()
+    ladder = get_badge_ladder(guild, role_affixes)
+
+    known_states = {}
+    if store is not None:
+        known_states = load_badge_states(store, guild.id, ladder)
+
+    if fetch_members:
+        report.scanned, changes, correct_states = await fetch_badge_diff(
+            guild, role_affixes, known_states)
+    else:
+        report.scanned = len(guild.members)
+        changes, correct_states = compute_badge_diff(
+            guild, role_affixes, known_states)
+    failed = await apply_badge_changes(changes, status_channel, max_workers)
+
+    report.failed = len(failed)
+    report.changed = len(changes) - report.failed
+    report.skipped = report.scanned - len(changes)
+    report.unchanged_since_last_run = (
+        report.skipped - len(correct_states))
+
+    if store is not None:
+        failed_ids = {change.member.id for change in failed}
+        for change in changes:
+            if change.member.id not in failed_ids:
+                correct_states[change.member.id] = get_state_after_change(
+                    change, ladder)
+        store.save_member_badges(guild.id, correct_states)
+
+    report.elapsed = monotonic() - start
+    return report
@@ -0,0 +1,187 @@
+import asyncio
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from time import monotonic
+
+from discord import Member, Object, Role
+
+from member_updates import PendingRoleMutations, pending_role_mutations
+
+
+@dataclass
+class RoleWriteStats:
+    # Calls to add_roles or remove_roles that would have been made.
+    requested: int = 0
+    # Calls to Member.edit that were made.
+    written: int = 0
+    # Role changes undone by an opposite change before being written.
+    cancelled: int = 0
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.written
+
+    def __str__(self):
+        return (f'{self.written} role writes for {self.requested} requested,'
+                f' {self.saved} saved ({self.cancelled} changes cancelled'
+                f' out).')
+
+
+@dataclass
+class _Batch:
+    """Role changes of a member that will be written together."""
+    member: Member
+    # Role id to True to add it or False to remove it, in the order requested.
+    changes: dict[int, bool] = field(default_factory=dict)
+    reasons: list[str] = field(default_factory=list)
+    done: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class RoleWriteBuffer:
+    """Merges the role changes of a member into a single request.
+
+    Changes requested within `window` seconds of the first are written with
+    one Member.edit instead of an add_roles and a remove_roles call each. A
+    later change of a role replaces an earlier one, so adding and then
+    removing a role does nothing. Batches of a member are written one at a
+    time, in the order they were requested.
+    """
+
+    def __init__(self, window: float = 0.05,
+                 pending: PendingRoleMutations = pending_role_mutations,
+                 remember_for: float = 5.0):
+        self.window = window
+        self.pending = pending
+        # Discord's member update event for a write can arrive after the next
+        # batch is written, so the roles written are trusted over a cached
+        # member that still has the roles from before the write, for this many
+        # seconds.
+        self.remember_for = remember_for
+        self.stats = RoleWriteStats()
+        # Keyed by guild and member id, since a member has other roles in
+        # other guilds.
+        self._batches: dict[tuple[int, int], _Batch] = {}
+        self._writers: dict[tuple[int, int], asyncio.Task] = {}
+        # The roles before and after the last write to a member, and when it
+        # was written.
+        self._written: dict[tuple[int, int],
+                            tuple[frozenset[int], frozenset[int], float]] = {}
+
+    async def add_roles(self, member: Member, *roles: Role,
+                        reason: str|None = None):
+        await self.change_roles(member, add=roles, reason=reason)
+
+    async def remove_roles(self, member: Member, *roles: Role,
+                           reason: str|None = None):
+        await self.change_roles(member, remove=roles, reason=reason)
+
+    async def change_roles(self, member: Member, add: Iterable[Role] = (),
+                           remove: Iterable[Role] = (),
+                           reason: str|None = None,
+                           window: float|None = None):
+        """Add and remove roles of a member, and wait until they are written.
+
+        Set `window` to 0 when the change is known to be complete, e.g. when it
+        already has both the adds and the removes of the member.
+
+        Raise what Member.edit raised if the write failed.
+        """
+        add = list(add)
+        remove = list(remove)
+        self.stats.requested += bool(add) + bool(remove)
+        if not add and not remove:
+            return
+
+        key = (member.guild.id, member.id)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(member)
+            previous = self._writers.get(key)
+            self._writers[key] = asyncio.create_task(self._write(
+                batch, previous, self.window if window is None else window))
+        # The member object is the most recent one seen.
+        batch.member = member
+        for roles, adding in ((remove, False), (add, True)):
+            for role in roles:
+                if batch.changes.get(role.id, adding) != adding:
+                    self.stats.cancelled += 1
+                    # Keep the order of the changes.
+                    del batch.changes[role.id]
+                batch.changes[role.id] = adding
+        if reason:
+            batch.reasons.append(reason)
+        # Don't cancel the write for the other waiters of the batch.
+        await asyncio.shield(batch.done)
+
+    def _get_role_ids(self, member: Member, cached_role_ids: frozenset[int]
+                      ) -> frozenset[int]:
+        written = self._written.get((member.guild.id, member.id))
+        if written:
+            role_ids_before, role_ids_after, written_at = written
+            if (cached_role_ids == role_ids_before
+                    and monotonic() - written_at < self.remember_for):
+                return role_ids_after
+        return cached_role_ids
+
+    async def _write(self, batch: _Batch, previous: asyncio.Task|None,
+                     window: float):
+        await asyncio.sleep(window)
+        if previous is not None:
+            # Errors are raised to the waiters of the previous batch.
+            await asyncio.gather(previous, return_exceptions=True)
+        member = batch.member
+        key = (member.guild.id, member.id)
+        # Changes requested from now on go in the next batch.
+        del self._batches[key]
+        try:
+            # Without the @everyone role, which can't be given or taken.
+            cached_role_ids = frozenset(
+                role.id for role in member.roles if role.id != member.guild.id)
+            role_ids = self._get_role_ids(member, cached_role_ids)
+            new_role_ids = frozenset(
+                {role_id for role_id, adding in batch.changes.items()
+                 if adding}
+                | (role_ids - {role_id for role_id, adding
+                               in batch.changes.items() if not adding}))
+            if new_role_ids != role_ids:
+                # Let the update event caused by the write be recognised.
+                self.pending.expect(member, new_role_ids | {member.guild.id})
+                edited = await member.edit(
+                    roles=[Object(role_id) for role_id in new_role_ids],
+                    reason='; '.join(batch.reasons) or None)
+                self.stats.written += 1
+                if edited is not None:
+                    new_role_ids = frozenset(
+                        role.id for role in edited.roles
+                        if role.id != member.guild.id)
+                # Kept in the order written, oldest first.
+                self._written.pop(key, None)
+                self._written[key] = (
+                    cached_role_ids, new_role_ids, monotonic())
+            batch.done.set_result(None)
+        except Exception as error:
+            batch.done.set_exception(error)
+            # Marked as retrieved, in case every waiter was cancelled.
+            batch.done.exception()
+        finally:
+            if self._writers.get(key) is asyncio.current_task():
+                del self._writers[key]
+            self._forget_old_writes()
+
+    def forget_writes(self):
+        """Forget the roles written, and trust the cached members again."""
+        self._written.clear()
+
+    def _forget_old_writes(self):
+        now = monotonic()
+        while self._written:
+            key, (_, _, written_at) = next(iter(self._written.items()))
+            if now - written_at < self.remember_for:
+                break
+            del self._written[key]
+
+
+# Shared by everything that changes the roles of members, so that their
+# changes are merged.
+role_writes = RoleWriteBuffer()
@@ -0,0 +1,177 @@
+import asyncio
+from dataclasses import dataclass, field
+from time import monotonic
+
+import discord
+
+from bot_logging import log
+from public_category import same_overwrites
+
+# Denied for everyone in the categories of past years, so that they can still
+# be read but not written in.
+_WRITE_PERMISSIONS = dict(
+    send_messages=False, send_messages_in_threads=False,
+    create_public_threads=False, create_private_threads=False,
+    add_reactions=False, speak=False)
+
+
+def get_year(name: str, prefix: str) -> int|None:
+    """Get the year of a name like `<prefix> <year>`."""
+    if not name.startswith(f'{prefix} '):
+        return None
+    year = name.removeprefix(f'{prefix} ')
+    return int(year) if year.isdigit() else None
+
+
+def plan_year_role_positions(guild: discord.Guild, year_role_prefix: str
+                             ) -> dict[discord.Role, int]:
+    """Compute the positions that order the year roles, the newest lowest.
+
+    The year roles keep the positions they already take up, so other roles
+    don't move. Only the roles that change position are returned.
+    """
+    years = {role: get_year(role.name, year_role_prefix)
+             for role in guild.roles}
+    year_roles = [role for role, year in years.items() if year is not None]
+    positions = sorted(role.position for role in year_roles)
+    ordered = sorted(year_roles, key=lambda role: (-years[role], role.id))
+    return {role: position for role, position in zip(ordered, positions)
+            if role.position != position}
+
+
+def plan_category_positions(guild: discord.Guild, year: int,
+                            year_category_prefix: str
+                            ) -> dict[discord.CategoryChannel, int]:
+    """Compute the positions that move the categories of years before `year`
+    to the bottom, the newest first.
+
+    Only the categories that change position are returned.
+    """
+    categories = guild.categories
+    years = {category: get_year(category.name, year_category_prefix)
+             for category in categories}
+    past = sorted(
+        (category for category in categories
+         if years[category] is not None and years[category] < year),
+        key=lambda category: (-years[category], category.id))
+    ordered = [category for category in categories
+               if category not in past] + past
+    positions = sorted(category.position for category in categories)
+    return {category: position
+            for category, position in zip(ordered, positions)
+            if category.position != position}
+
+
+def get_locked_overwrites(
+    guild: discord.Guild,
+    overwrites: dict[discord.abc.Snowflake, discord.PermissionOverwrite]
+) -> dict[discord.abc.Snowflake, discord.PermissionOverwrite]:
+    """Copy the overwrites, with every write permission denied."""
+    locked = {target: discord.PermissionOverwrite.from_pair(*overwrite.pair())
+              for target, overwrite in overwrites.items()}
+    locked.setdefault(guild.default_role, discord.PermissionOverwrite())
+    for overwrite in locked.values():
+        overwrite.update(**_WRITE_PERMISSIONS)
+    return locked
+
+
+@dataclass
+class RolloverReport:
+    roles_moved: int = 0
+    categories_locked: int = 0
+    channels_locked: int = 0
+    categories_moved: int = 0
+    # Seconds per phase, in the order they ran.
+    phase_times: dict[str, float] = field(default_factory=dict)
+
+    def __str__(self):
+        times = ', '.join(f'{phase} {elapsed:.2f} s'
+                          for phase, elapsed in self.phase_times.items())
+        return (f'{self.roles_moved} roles moved, {self.categories_locked}'
+                f' categories and {self.channels_locked} channels locked,'
+                f' {self.categories_moved} categories moved ({times}).')
+
+
+async def roll_over_year(guild: discord.Guild,
+                         status_channel: discord.TextChannel, year: int,
+                         year_role_prefix: str, year_category_prefix: str,
+                         max_concurrency: int = 4,
+                         dry_run: bool = False) -> RolloverReport:
+    """Order the year roles and archive the categories of past years.
+
+    Every reorder of roles or channels makes Discord sort all of them again,
+    so the final order is computed first and written with a single positions
+    request per kind. The categories of years before `year` are made read
+    only and moved to the bottom.
+    """
+    report = RolloverReport()
+    start = monotonic()
+
+    def end_phase(name: str):
+        nonlocal start
+        report.phase_times[name] = monotonic() - start
+        start = monotonic()
+
+    role_positions = plan_year_role_positions(guild, year_role_prefix)
+    category_positions = plan_category_positions(
+        guild, year, year_category_prefix)
+    # The overwrites to lock every past category and channel with.
+    locks = {}
+    for category in guild.categories:
+        category_year = get_year(category.name, year_category_prefix)
+        if category_year is None or category_year >= year:
+            continue
+        locked = get_locked_overwrites(guild, category.overwrites)
+        if not same_overwrites(category.overwrites, locked):
+            locks[category] = locked
+            report.categories_locked += 1
+        for channel in category.channels:
+            if same_overwrites(channel.overwrites, category.overwrites):
+                # Given the locked overwrites of the category, so that it
+                # stays synced. Syncing with sync_permissions would send the
+                # cached overwrites, which are only updated by the gateway.
+                if category in locks:
+                    locks[channel] = locks[category]
+                continue
+            # Syncing would drop the channel's own overwrites.
+            locked = get_locked_overwrites(guild, channel.overwrites)
+            if not same_overwrites(channel.overwrites, locked):
+                locks[channel] = locked
+    report.roles_moved = len(role_positions)
+    report.categories_moved = len(category_positions)
+    report.channels_locked = len(locks) - report.categories_locked
+    end_phase('plan')
+    if dry_run:
+        return report
+
+    if role_positions:
+        await guild.edit_role_positions(
+            positions=role_positions, reason=f'Rollover to {year}')
+        await log(status_channel, f'Ordered {len(role_positions)} year roles.')
+    end_phase('roles')
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def lock(target: discord.abc.GuildChannel, overwrites):
+        async with semaphore:
+            await target.edit(overwrites=overwrites,
+                              reason=f'Archived by the rollover to {year}')
+
+    # There is no bulk request for overwrites, so each one is a request.
+    await asyncio.gather(*(lock(target, overwrites)
+                           for target, overwrites in locks.items()))
+    if locks:
+        await log(status_channel, f'Locked {len(locks)} categories and channels of past years.')
+    end_phase('lock')
+
+    # The categories are moved in one request. discord.py only exposes this
+    # request through single channel moves, which send the whole order once
+    # per moved category.
+    payload = [{'id': category.id, 'position': position}
+               for category, position in category_positions.items()]
+    if payload:
+        await guild._state.http.bulk_channel_update(
+            guild.id, payload, reason=f'Rollover to {year}')
+        await log(status_channel, f'Moved {len(category_positions)} categories of past years to the bottom.')
+    end_phase('channels')
+    return report
@@ -0,0 +1,205 @@
+import asyncio
+import csv
+from dataclasses import dataclass, field, replace
+import io
+from time import monotonic
+
+import discord
+
+from reconcile import RateLimitGate
+from role_writes import role_writes
+from seniority_badge import BadgeLadder
+
+# Discord resolves at most this many member ids per request.
+QUERY_CHUNK_SIZE = 100
+
+# Headers that are skipped if they are on the first row.
+_HEADERS = {'member', 'id', 'user', 'username', 'name'}
+
+
+@dataclass
+class RosterRow:
+    """A row of a roster, and what happened to its member."""
+    number: int
+    text: str
+    member_id: int|None = None
+    member: discord.Member|None = None
+    status: str = 'not found'
+
+
+def _parse_member_id(text: str) -> int|None:
+    # Mentions look like <@123> or <@!123>.
+    text = text.removeprefix('<@').removeprefix('!').removesuffix('>')
+    return int(text) if text.isdigit() else None
+
+
+def parse_roster(data: bytes) -> list[RosterRow]:
+    """Parse a CSV file with a member id, mention or username first on every
+    row."""
+    rows = []
+    reader = csv.reader(io.StringIO(data.decode('utf-8-sig')))
+    for number, cells in enumerate(reader, start=1):
+        text = cells[0].strip() if cells else ''
+        if not text or (number == 1 and text.lower() in _HEADERS):
+            continue
+        rows.append(RosterRow(number, text.removeprefix('@'),
+                              _parse_member_id(text)))
+    return rows
+
+
+async def resolve_roster(guild: discord.Guild, rows: list[RosterRow],
+                         cache: bool = True, max_concurrency: int = 4):
+    """Find the member of every row, from the member cache if possible.
+
+    The other members are queried from Discord, 100 ids per request. Usernames
+    have to be queried one at a time.
+    """
+    members_by_name = {}
+    missing_ids = set()
+    missing_names = set()
+    for row in rows:
+        if row.member_id is not None:
+            if guild.get_member(row.member_id) is None:
+                missing_ids.add(row.member_id)
+        elif cache and not members_by_name:
+            members_by_name = {member.name.lower(): member
+                               for member in guild.members}
+        if row.member_id is None and row.text.lower() not in members_by_name:
+            missing_names.add(row.text.lower())
+
+    fetched = {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def query(**kwargs):
+        async with semaphore:
+            members = await guild.query_members(cache=cache, **kwargs)
+        for member in members:
+            fetched[member.id] = member
+            fetched.setdefault(member.name.lower(), member)
+
+    missing_ids = sorted(missing_ids)
+    await asyncio.gather(
+        *(query(user_ids=missing_ids[i:i + QUERY_CHUNK_SIZE],
+                limit=QUERY_CHUNK_SIZE)
+          for i in range(0, len(missing_ids), QUERY_CHUNK_SIZE)),
+        # Usernames are matched by prefix, so the exact match is picked below.
+        *(query(query=name, limit=5) for name in missing_names))
+
+    for row in rows:
+        if row.member_id is not None:
+            row.member = (guild.get_member(row.member_id)
+                          or fetched.get(row.member_id))
+        else:
+            name = row.text.lower()
+            row.member = members_by_name.get(name) or fetched.get(name)
+
+
+@dataclass
+class RosterReport:
+    rows: list[RosterRow] = field(default_factory=list)
+    resolve_time: float = 0.0 # seconds
+    write_time: float = 0.0 # seconds
+    writes: int = 0
+
+    def count(self, status: str) -> int:
+        return sum(row.status == status for row in self.rows)
+
+    def to_csv(self) -> str:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(('row', 'input', 'member_id', 'member', 'status'))
+        for row in self.rows:
+            writer.writerow((
+                row.number, row.text, row.member.id if row.member else '',
+                row.member.name if row.member else '', row.status))
+        return output.getvalue()
+
+    def __str__(self):
+        failed = sum(row.status.startswith('failed') for row in self.rows)
+        rate = self.writes / self.write_time if self.write_time else 0.0
+        return (f'{len(self.rows)} rows: {self.count("assigned")} assigned,'
+                f' {self.count("unchanged")} unchanged,'
+                f' {self.count("duplicate")} duplicates,'
+                f' {self.count("not found")} not found, {failed} failed.'
+                f' Members found in {self.resolve_time:.2f} s, {self.writes}'
+                f' role writes in {self.write_time:.2f} s'
+                f' ({rate:.1f} writes/s).')
+
+
+async def assign_roster(rows: list[RosterRow], year_role: discord.Role,
+                        ladder: BadgeLadder, max_workers: int = 4,
+                        max_rate: float = 5.0, max_attempts: int = 3
+                        ) -> int:
+    """Give the members of the rows the year role and the badge that goes with
+    it, in a single write per member.
+
+    At most `max_rate` writes are started per second, by at most `max_workers`
+    at a time. The status of every row is set, and the number of successful
+    writes is returned.
+    """
+    if year_role.id not in ladder.year_role_ids:
+        # The role was just created, so the ladder might not know it yet.
+        ladder = replace(
+            ladder, year_role_ids=ladder.year_role_ids | {year_role.id})
+    guild = ladder.guild
+    queue = asyncio.Queue()
+    seen = set()
+    for row in rows:
+        if row.member is None:
+            continue
+        # The same member on several rows is only written once.
+        if row.member.id in seen:
+            row.status = 'duplicate'
+            continue
+        seen.add(row.member.id)
+        queue.put_nowait(row)
+
+    gate = RateLimitGate()
+    next_write_at = monotonic()
+    writes = 0
+
+    async def worker():
+        nonlocal next_write_at, writes
+        while True:
+            try:
+                row = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            member = row.member
+            role_ids = {role.id for role in member.roles} | {year_role.id}
+            badge_id_to_add, badge_ids_to_remove = ladder.decide(role_ids)
+            add = [year_role]
+            if badge_id_to_add:
+                add.append(guild.get_role(badge_id_to_add))
+            remove = [guild.get_role(role_id)
+                      for role_id in badge_ids_to_remove]
+            if member.get_role(year_role.id) and len(add) == 1 and not remove:
+                row.status = 'unchanged'
+                continue
+
+            for attempt in range(1, max_attempts + 1):
+                # Spread the writes out evenly.
+                delay = next_write_at - monotonic()
+                next_write_at = max(next_write_at, monotonic()) + 1 / max_rate
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await gate.wait()
+                try:
+                    await role_writes.change_roles(
+                        member, add=add, remove=remove,
+                        reason='Competitor roster', window=0)
+                    writes += 1
+                    row.status = 'assigned'
+                    break
+                except discord.RateLimited as error:
+                    gate.pause(error.retry_after)
+                    row.status = 'failed: rate limited'
+                except discord.HTTPException as error:
+                    row.status = f'failed: {error.status} {error.text}'
+                    # Only rate limits and server errors are worth retrying.
+                    if error.status != 429 and error.status < 500:
+                        break
+                    gate.pause(2 ** attempt)
+
+    await asyncio.gather(*(worker() for _ in range(max_workers)))
+    return writes
@@ -0,0 +1,52 @@
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from discord import Member, Message
+
+MessageHandler = Callable[[Message], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class Route:
+    """A handler of the messages in a channel."""
+    handler: MessageHandler
+    # Only members with at least one of these roles may use the handler. None
+    # allows everyone.
+    allowed_role_ids: frozenset[int]|None = None
+    # Called instead of the handler for members without an allowed role.
+    denied_handler: MessageHandler|None = None
+
+
+class MessageRouter:
+    """Sends messages to the handlers registered for their channel.
+
+    Messages in channels without handlers are dropped with a single dict
+    lookup, which is what happens to almost every message.
+    """
+
+    def __init__(self):
+        self.routes: dict[int, list[Route]] = {}
+
+    def add_route(self, channel_id: int, handler: MessageHandler,
+                  allowed_role_ids: frozenset[int]|None = None,
+                  denied_handler: MessageHandler|None = None):
+        self.routes.setdefault(channel_id, []).append(
+            Route(handler, allowed_role_ids, denied_handler))
+
+    async def dispatch(self, message: Message):
+        routes = self.routes.get(message.channel.id)
+        if routes is None:
+            return
+
+        # Ignore messages from bots. Prevents infinite loops.
+        if message.author.bot:
+            return
+
+        for route in routes:
+            if route.allowed_role_ids is None or (
+                    isinstance(message.author, Member)
+                    and any(message.author.get_role(role_id)
+                            for role_id in route.allowed_role_ids)):
+                await route.handler(message)
+            elif route.denied_handler:
+                await route.denied_handler(message)
@@ -1,11 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from enum import Enum
+from functools import cached_property
 
-from discord import Member
+from discord import Guild, Member, Role
 
 from bot_logging import log
+from role_writes import role_writes
 
 
-@dataclass
+@dataclass(frozen=True)
 class RoleAffixes:
     """Prefixes and suffixes for the roles."""
     year_prefix: str
@@ -13,44 +16,189 @@ class RoleAffixes:
     badge_suffix: str
 
 
+class RoleKind(Enum):
+    """What a role means for the seniority badges."""
+    OTHER = 0
+    YEAR = 1
+    BADGE = 2
+
+
+@dataclass(frozen=True)
+class BadgeLadder:
+    """The badge roles of a guild ordered by seniority, and the kind of every
+    year and badge role.
+
+    The index of a badge role in `badge_role_ids` is the number of years
+    participated. Index 0 is None since first having participated gives a
+    badge.
+    """
+    guild: Guild
+    badge_role_ids: tuple[int|None, ...]
+    role_kinds: dict[int, RoleKind]
+    year_role_ids: frozenset[int]
+    # All roles with the badge prefix, even those missing the suffix. Members
+    # should never keep any of these except the correct one.
+    any_badge_role_ids: frozenset[int]
+
+    @cached_property
+    def badge_related_role_ids(self) -> frozenset[int]:
+        return self.year_role_ids | self.any_badge_role_ids
+
+    def kind(self, role_id: int) -> RoleKind:
+        return self.role_kinds.get(role_id, RoleKind.OTHER)
+
+    def correct_badge_id(self, years: int) -> int|None:
+        """Get the badge for the number of years participated."""
+        # Clamp the badge index to the valid range [0, len(badge_roles) - 1)
+        return self.badge_role_ids[min(years, len(self.badge_role_ids) - 1)]
+
+    def decide(self, role_ids: set[int]|frozenset[int]
+               ) -> tuple[int|None, set[int]]:
+        """Decide which badge to add and which to remove from a member with the
+        given roles.
+
+        Return the id of the badge role to add, if any, and the ids of the
+        badge roles to remove.
+        """
+        correct_badge_id = self.correct_badge_id(
+            len(role_ids & self.year_role_ids))
+        current_badge_ids = role_ids & self.any_badge_role_ids
+        badge_id_to_add = (
+            correct_badge_id
+            if correct_badge_id and correct_badge_id not in current_badge_ids
+            else None)
+        return badge_id_to_add, current_badge_ids - {correct_badge_id}
+
+
+def build_badge_ladder(guild: Guild, role_affixes: RoleAffixes
+                       ) -> BadgeLadder:
+    role_kinds = {}
+    badge_roles = []
+    for role in guild.roles:
+        if role.name.startswith(role_affixes.year_prefix):
+            role_kinds[role.id] = RoleKind.YEAR
+        elif role.name.startswith(role_affixes.badge_prefix):
+            role_kinds[role.id] = RoleKind.BADGE
+            if role.name.endswith(role_affixes.badge_suffix):
+                badge_roles.append(role)
+    # Sort explicitly by position instead of relying on the order of
+    # Guild.roles. The most senior badge is the highest role.
+    badge_roles.sort(key=lambda role: (role.position, role.id))
+    return BadgeLadder(
+        guild=guild,
+        badge_role_ids=(None, *(role.id for role in badge_roles)),
+        role_kinds=role_kinds,
+        year_role_ids=frozenset(
+            role_id for role_id, kind in role_kinds.items()
+            if kind == RoleKind.YEAR),
+        any_badge_role_ids=frozenset(
+            role_id for role_id, kind in role_kinds.items()
+            if kind == RoleKind.BADGE))
+
+
+def validate_badge_ladder(ladder: BadgeLadder, role_affixes: RoleAffixes
+                          ) -> list[str]:
+    """Check that the badge roles can be ordered by seniority.
+
+    Return a description of every problem found.
+    """
+    problems = []
+    badge_roles = [ladder.guild.get_role(role_id)
+                   for role_id in ladder.badge_role_ids[1:]]
+    if not badge_roles:
+        problems.append('No badge roles found.')
+    positions = [role.position for role in badge_roles]
+    if len(set(positions)) != len(positions):
+        problems.append(
+            'Several badge roles have the same position, so their seniority'
+            ' is ambiguous.')
+    if (role_affixes.year_prefix.startswith(role_affixes.badge_prefix)
+            or role_affixes.badge_prefix.startswith(role_affixes.year_prefix)):
+        problems.append(
+            'The year and badge prefixes overlap, so some roles may be'
+            ' counted as the wrong kind.')
+    return problems
+
+
+_badge_ladders: dict[int, BadgeLadder] = {}
+
+
+def get_badge_ladder(guild: Guild, role_affixes: RoleAffixes) -> BadgeLadder:
+    """Get the cached badge ladder of the guild, building it if needed."""
+    ladder = _badge_ladders.get(guild.id)
+    if ladder is None or ladder.guild is not guild:
+        ladder = _badge_ladders[guild.id] = build_badge_ladder(
+            guild, role_affixes)
+    return ladder
+
+
+def invalidate_badge_ladder(guild: Guild):
+    """Forget the badge ladder after the roles of the guild changed."""
+    _badge_ladders.pop(guild.id, None)
+
+
+@dataclass
+class BadgeChange:
+    """The roles that must be added and removed to give a member the correct
+    seniority badge."""
+    member: Member
+    role_to_add: Role|None = None
+    roles_to_remove: list[Role] = field(default_factory=list)
+
+
+def compute_badge_change(member: Member, role_affixes: RoleAffixes,
+                         ladder: BadgeLadder|None = None,
+                         role_ids: set[int]|None = None
+                         ) -> BadgeChange|None:
+    """Compute which badge roles the member is missing or should not have.
+
+    No requests are made to Discord. Return None if the member already has the
+    correct badge.
+    """
+    if ladder is None:
+        ladder = get_badge_ladder(member.guild, role_affixes)
+    if role_ids is None:
+        role_ids = {role.id for role in member.roles}
+
+    badge_id_to_add, badge_ids_to_remove = ladder.decide(role_ids)
+    if not badge_id_to_add and not badge_ids_to_remove:
+        return None
+
+    # A role deleted before the ladder is invalidated is gone from the guild.
+    guild = member.guild
+    role_to_add = guild.get_role(badge_id_to_add) if badge_id_to_add else None
+    roles_to_remove = sorted(
+        role for role_id in badge_ids_to_remove
+        if (role := guild.get_role(role_id)) is not None)
+    if not role_to_add and not roles_to_remove:
+        return None
+    return BadgeChange(member, role_to_add, roles_to_remove)
+
+
+async def apply_badge_change(change: BadgeChange, status_channel: str,
+                             window: float|None = None):
+    """Add and remove the roles of a badge change.
+
+    They are written together, along with any other role changes of the member
+    requested within `window` seconds.
+    """
+    member = change.member
+    if change.role_to_add:
+        await log(status_channel, f'Adding role {change.role_to_add.name} to {member.name}')
+    if change.roles_to_remove:
+        await log(status_channel, f'Removing roles {", ".join(role.name for role in change.roles_to_remove)} from {member.name}')
+    await role_writes.change_roles(
+        member, add=[change.role_to_add] if change.role_to_add else [],
+        remove=change.roles_to_remove, reason='Seniority badge',
+        window=window)
+
+
 async def adjust_badge_roles(member: Member, role_affixes: RoleAffixes,
-                             status_channel: str):
-    badge_roles = [
-        role for role in member.guild.roles
-        if role.name.startswith(role_affixes.badge_prefix)
-        and role.name.endswith(role_affixes.badge_suffix)]
-
-    # Add None to the list of badge roles so that the index correspond to
-    # the number of years participated.
-    # XXX: This works because the roles are retrieved from lowest role to
-    # highest.
-    badge_roles = (
-        None,
-        *badge_roles
-    )
-
-    current_year_roles = [
-        role for role in member.roles
-        if role.name.startswith(role_affixes.year_prefix)]
-
-    # Clamp the badge index to the valid range [0, len(badge_roles) - 1)
-    badge_role_index = min(len(current_year_roles), len(badge_roles) - 1)
-
-    # Choose the correct role based on the number of years participated.
-    correct_badge_role = badge_roles[badge_role_index]
-
-    current_badge_roles = [
-        role for role in member.roles
-        if role.name.startswith(role_affixes.badge_prefix)]
-
-    roles_to_remove = [
-        role for role in current_badge_roles
-        if role and role != correct_badge_role]
+                             status_channel: str) -> BadgeChange|None:
+    """Give the member the correct badge, and return the change written."""
+    change = compute_badge_change(member, role_affixes)
 
     # Add and remove roles as necessary.
-    if correct_badge_role and not correct_badge_role in current_badge_roles:
-        await log(status_channel, f'Adding role {correct_badge_role.name} to {member.name}')
-        await member.add_roles(correct_badge_role)
-    if roles_to_remove:
-        await log(status_channel, f'Removing roles {", ".join(role.name for role in roles_to_remove)} from {member.name}')
-        await member.remove_roles(*roles_to_remove)
\ No newline at end of file
+    if change:
+        await apply_badge_change(change, status_channel)
+    return change
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+import json
+import os
+from time import monotonic
+
+# Imported first by main.py, so this is about when the bot started.
+_started_at = monotonic()
+
+# How many runs are kept in the profile file.
+MAX_RUNS = 50
+
+
+@dataclass
+class Phase:
+    name: str
+    # Seconds since the bot started.
+    start: float
+    end: float|None = None
+    guild: str|None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or self.start) - self.start
+
+
+class StartupProfiler:
+    """A timeline of the phases of the startup, until every guild is ready.
+
+    Phases can overlap, e.g. the startups of different guilds.
+    """
+
+    def __init__(self, started_at: float = _started_at):
+        self.started_at = started_at
+        self.phases: list[Phase] = []
+        self.done = False
+
+    def _now(self) -> float:
+        return monotonic() - self.started_at
+
+    def start(self, name: str, guild: str|None = None) -> Phase:
+        phase = Phase(name, self._now(), guild=guild)
+        if not self.done:
+            self.phases.append(phase)
+        return phase
+
+    def end(self, phase: Phase):
+        phase.end = self._now()
+
+    def end_named(self, name: str):
+        """End the last phase started with the name, if it is still going."""
+        for phase in reversed(self.phases):
+            if phase.name == name and phase.end is None:
+                self.end(phase)
+                return
+
+    @contextmanager
+    def phase(self, name: str, guild: str|None = None):
+        phase = self.start(name, guild)
+        try:
+            yield phase
+        finally:
+            self.end(phase)
+
+    def format_timeline(self) -> list[str]:
+        return [
+            f'{phase.start:8.3f} s {phase.duration:8.3f} s  {phase.name}'
+            + (f' ({phase.guild})' if phase.guild else '')
+            for phase in sorted(self.phases, key=lambda phase: phase.start)]
+
+    def finish(self, filename: str = '') -> list[str]:
+        """Stop recording, and add the run to the JSON file if a filename is
+        given.
+
+        Return the lines of the timeline.
+        """
+        self.done = True
+        if filename:
+            self._save(filename)
+        total = self._now()
+        return [f'Ready {total:.3f} s after starting:',
+                *self.format_timeline()]
+
+    def _save(self, filename: str):
+        run = {
+            'started': datetime.now(timezone.utc).isoformat(
+                timespec='seconds'),
+            'time_to_ready': self._now(),
+            'phases': [asdict(phase) for phase in self.phases],
+        }
+        runs = []
+        if os.path.exists(filename):
+            try:
+                with open(filename, encoding='utf-8') as json_file:
+                    runs = json.load(json_file)
+            except (OSError, ValueError) as error:
+                print(f'Could not read {filename}, starting over: {error}')
+        runs = [*runs, run][-MAX_RUNS:]
+        with open(filename, 'w', encoding='utf-8') as json_file:
+            json.dump(runs, json_file, indent=1)
+
+
+# Shared by everything that runs during the startup.
+startup_profiler = StartupProfiler()
@@ -0,0 +1,86 @@
+import sqlite3
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class MemberBadgeState:
+    """The year and badge roles a member had when last reconciled."""
+    year_role_ids: frozenset[int]
+    badge_role_ids: frozenset[int]
+
+
+def _join_ids(ids: frozenset[int]) -> str:
+    return ','.join(str(i) for i in sorted(ids))
+
+
+def _split_ids(text: str) -> frozenset[int]:
+    return frozenset(int(i) for i in text.split(',') if i)
+
+
+class StateStore:
+    """What the bot knew when it last ran, stored in an SQLite database.
+
+    This lets a restarted bot skip work that was already done, like checking
+    the badges of members whose roles did not change.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        # Write-ahead logging makes the many small writes cheap, and a crash
+        # can't corrupt the database.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS member_badges (
+                    guild_id INTEGER NOT NULL,
+                    member_id INTEGER NOT NULL,
+                    year_role_ids TEXT NOT NULL,
+                    badge_role_ids TEXT NOT NULL,
+                    PRIMARY KEY (guild_id, member_id));
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL);
+            ''')
+
+    def close(self):
+        self.connection.close()
+
+    def load_member_badges(self, guild_id: int
+                           ) -> dict[int, MemberBadgeState]:
+        rows = self.connection.execute(
+            'SELECT member_id, year_role_ids, badge_role_ids'
+            ' FROM member_badges WHERE guild_id = ?',
+            (guild_id,))
+        return {
+            member_id: MemberBadgeState(
+                _split_ids(year_role_ids), _split_ids(badge_role_ids))
+            for member_id, year_role_ids, badge_role_ids in rows}
+
+    def save_member_badges(self, guild_id: int,
+                           states: dict[int, MemberBadgeState]):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO member_badges VALUES (?, ?, ?, ?)',
+                ((guild_id, member_id, _join_ids(state.year_role_ids),
+                  _join_ids(state.badge_role_ids))
+                 for member_id, state in states.items()))
+
+    def clear_member_badges(self, guild_id: int):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM member_badges WHERE guild_id = ?', (guild_id,))
+
+    def get_meta(self, key: str) -> str|None:
+        row = self.connection.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def delete_meta(self, key: str):
+        with self.connection:
+            self.connection.execute('DELETE FROM meta WHERE key = ?', (key,))
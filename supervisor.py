@@ -0,0 +1,116 @@
+import asyncio
+from dataclasses import dataclass, field
+import random
+from time import monotonic
+
+import aiohttp
+import discord
+
+# Errors that are likely to go away by waiting and trying again.
+# ConnectionClosed is not one: it only escapes connect() for close codes that
+# are fatal, like an invalid token or disallowed intents, after discord.py
+# already closed the client.
+TRANSIENT_ERRORS = (
+    OSError, # Includes aiohttp.ClientConnectorError and socket errors.
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+    discord.GatewayNotFound,
+    discord.DiscordServerError,
+)
+
+
+@dataclass
+class ConnectionMetrics:
+    """How well the client stays connected."""
+    started_at: float = field(default_factory=monotonic)
+    reconnects: int = 0
+    failed_attempts: int = 0
+    # Total seconds spent disconnected, not counting the ongoing outage.
+    downtime: float = 0.0
+    disconnected_at: float|None = None
+    # Seconds from starting or losing the connection until being ready.
+    time_to_ready: list[float] = field(default_factory=list)
+    last_error: str|None = None
+
+    def mark_disconnected(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = monotonic()
+
+    def mark_connected(self):
+        """The connection was resumed, or became ready."""
+        if self.disconnected_at is not None:
+            self.downtime += monotonic() - self.disconnected_at
+            self.disconnected_at = None
+            self.reconnects += 1
+
+    def mark_ready(self):
+        since = (self.disconnected_at if self.disconnected_at is not None
+                 else self.started_at if not self.time_to_ready
+                 else None)
+        if since is not None:
+            self.time_to_ready.append(monotonic() - since)
+        self.mark_connected()
+
+    def __str__(self):
+        text = (f'{self.reconnects} reconnects, {self.failed_attempts} failed'
+                f' attempts, {self.downtime:.1f} s downtime')
+        if self.time_to_ready:
+            text += f', last time to ready {self.time_to_ready[-1]:.1f} s'
+        return text + '.'
+
+
+class Supervisor:
+    """Logs a client in and keeps it running.
+
+    discord.py resumes and reconnects the gateway by itself, retrying network
+    errors and timeouts internally, so in practice the supervisor only retries
+    a login that failed, e.g. because Discord could not be reached. It waits
+    with exponential backoff and jitter before trying again with the same
+    client. Fatal errors, like a wrong token or disallowed intents, are
+    raised.
+    """
+
+    def __init__(self, client: discord.Client, token: str,
+                 metrics: ConnectionMetrics,
+                 initial_delay: float = 1.0, max_delay: float = 300.0):
+        self.client = client
+        self.token = token
+        self.metrics = metrics
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int) -> float:
+        """Get the time to wait before trying again, with full jitter."""
+        return random.uniform(
+            0, min(self.max_delay, self.initial_delay * 2 ** attempt))
+
+    async def run(self):
+        """Log in and stay connected until the client is closed."""
+        attempt = 0
+        logged_in = False
+        times_ready = 0
+        while not self.client.is_closed():
+            try:
+                if not logged_in:
+                    await self.client.login(self.token)
+                    logged_in = True
+                times_ready = len(self.metrics.time_to_ready)
+                await self.client.connect(reconnect=True)
+                # Only returns without error if the client was closed.
+                return
+            except (discord.LoginFailure, discord.ConnectionClosed):
+                # Trying again will not fix a wrong token, disallowed intents
+                # or missing sharding.
+                raise
+            except TRANSIENT_ERRORS as error:
+                self.metrics.mark_disconnected()
+                self.metrics.failed_attempts += 1
+                self.metrics.last_error = repr(error)
+                # Start over with a short delay if the connection had worked.
+                if logged_in and len(self.metrics.time_to_ready) > times_ready:
+                    attempt = 0
+                delay = self.get_delay(attempt)
+                attempt += 1
+                print(f'Connection failed: {error!r}')
+                print(f'Retrying in {delay:.1f} seconds...')
+                await asyncio.sleep(delay)